@@ -0,0 +1,451 @@
+#!/usr/bin/python
+"""Generate synthetic Time Machine volumes and benchmark timecopy on them.
+
+Invoke this script with '--help' option for detailed description of
+what it does and how you can use it.
+
+"""
+
+#
+# Copyright (c) 2009-2017 Nathan Fiedler
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import getopt
+import io
+import math
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import xattr
+
+import timecopy
+
+# Number of files in each of the generated directories.
+FILES_PER_DIR = 50
+
+# Number of directories in each of the generated directories.
+DIRS_PER_DIR = 20
+
+
+class Generator:
+    """Builds a synthetic Time Machine volume in a plain directory.
+
+    The first snapshot is populated with files of random sizes, some of
+    which are hard links to others, and some of which have an extended
+    attribute. Each subsequent snapshot modifies, removes, and adds a
+    fraction (the churn) of the files, and hard links the rest to the
+    previous snapshot, as Time Machine does. Directories cannot be hard
+    linked on most systems, so they are created anew in every snapshot;
+    an unchanged directory is thus modelled as its files being linked.
+    """
+
+    def __init__(self, base, host='bench', seed=0):
+        """Initialize a Generator of a volume at base, for host."""
+        self.base = base
+        self.hostdir = os.path.join(base, 'Backups.backupdb', host)
+        self.random = random.Random(seed)
+        self.snapshots = []
+        self.files = []
+        self.serial = 0
+
+    def generate(self, snapshots=5, files=10000, churn=0.05, minsize=0,
+                 maxsize=1024 * 1024, links=0.05, xattrs=0.1):
+        """Generate the volume.
+
+        snapshots is the number of snapshots, and files the number of files
+        in each. churn is the fraction of the files modified, and half that
+        added and removed, in each snapshot after the first. Sizes are
+        distributed evenly on a log scale from minsize to maxsize bytes.
+        links is the fraction of new files that are hard links to another
+        new file, and xattrs the fraction that have extended attributes.
+        """
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.links = links
+        self.xattrs = xattrs
+        os.makedirs(self.hostdir)
+        # The MAC address dotfile that Time Machine creates.
+        with open(os.path.join(self.base, '.0123456789ab'), 'wb') as fobj:
+            fobj.write('bench\n')
+        started = time.mktime((2020, 1, 1, 0, 0, 0, 0, 0, -1))
+        for number in range(snapshots):
+            name = time.strftime('%Y-%m-%d-%H%M%S',
+                                 time.localtime(started + number * 86400))
+            self.snapshot(name, files, churn if number else None)
+        os.symlink(self.snapshots[-1], os.path.join(self.hostdir, 'Latest'))
+
+    def snapshot(self, name, files, churn):
+        """Generate the snapshot called name.
+
+        If churn is None, this is the first snapshot, with all new files.
+        """
+        prev = self.snapshots[-1] if self.snapshots else None
+        self.snapshots.append(name)
+        root = os.path.join(self.hostdir, name)
+        os.mkdir(root)
+        if churn is None:
+            changed = set()
+            self.files = [self.newname() for _ in range(files)]
+            fresh = set(self.files)
+        else:
+            count = int(len(self.files) * churn / 2)
+            for _ in range(count):
+                if self.files:
+                    del self.files[self.random.randrange(len(self.files))]
+            added = [self.newname() for _ in range(count)]
+            changed = set(self.random.sample(
+                self.files, min(len(self.files), count * 2)))
+            self.files.extend(added)
+            fresh = set(added)
+        written = []
+        for path in sorted(self.files):
+            dst = os.path.join(root, path)
+            parent = os.path.dirname(dst)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            if path in fresh and written and \
+                    self.random.random() < self.links:
+                # Share the inode with another new file.
+                os.link(self.random.choice(written), dst)
+            elif path in fresh or path in changed:
+                self.write(dst)
+                written.append(dst)
+            else:
+                os.link(os.path.join(self.hostdir, prev, path), dst)
+
+    def newname(self):
+        """Return the relative path for a new file."""
+        self.serial += 1
+        number = self.serial
+        dirs = []
+        dir = number // FILES_PER_DIR
+        while True:
+            dirs.append('d%02d' % (dir % DIRS_PER_DIR))
+            dir //= DIRS_PER_DIR
+            if not dir:
+                break
+        return os.path.join('Macintosh HD', *(dirs + ['f%07d' % number]))
+
+    def write(self, path):
+        """Write a new file at path, of random size and contents."""
+        low = math.log(self.minsize + 1)
+        high = math.log(self.maxsize + 1)
+        size = int(math.exp(self.random.uniform(low, high))) - 1
+        block = os.urandom(min(size, 4096))
+        with io.open(path, 'wb') as fobj:
+            remaining = size
+            while remaining:
+                remaining -= fobj.write(block[:remaining])
+        if self.xattrs and self.random.random() < self.xattrs:
+            try:
+                xattr.setxattr(path, 'user.com.apple.FinderInfo',
+                               block[:32].ljust(32, '\0'))
+            except IOError:
+                # The file system does not support them.
+                self.xattrs = 0
+
+
+class CallCounter:
+    """Counts the calls made to file system functions by timecopy.
+
+    The functions of the os, io, and xattr modules that make system calls
+    are replaced with wrappers that count how often they are called, as
+    are the stat() calls on the entries returned by scandir.
+    """
+
+    FUNCTIONS = ('chmod', 'chown', 'copy_file_range', 'fchmod', 'fchown',
+                 'lchown', 'link', 'listdir', 'lstat', 'mkdir', 'readlink',
+                 'sendfile', 'stat', 'symlink', 'unlink', 'utime')
+
+    def __init__(self):
+        """Initialize a CallCounter and install its wrappers."""
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.originals = []
+        for name in self.FUNCTIONS:
+            if hasattr(os, name):
+                self.wrap(os, name)
+        self.wrap(io, 'open')
+        self.wrap(xattr, 'xattr')
+        if timecopy.scandir is not None:
+            scandir = timecopy.scandir
+            counter = self
+
+            class Entry:
+                """Counts the stat() calls on a directory entry."""
+
+                def __init__(self, entry):
+                    self.entry = entry
+                    self.path = entry.path
+                    self.name = entry.name
+
+                def stat(self, **kwargs):
+                    counter.count('lstat')
+                    return self.entry.stat(**kwargs)
+
+            def wrapper(path):
+                counter.count('scandir')
+                return (Entry(entry) for entry in scandir(path))
+            self.originals.append((timecopy, 'scandir', scandir))
+            timecopy.scandir = wrapper
+
+    def wrap(self, module, name):
+        """Replace module.name with a wrapper counting its calls."""
+        func = getattr(module, name)
+
+        def wrapper(*args, **kwargs):
+            self.count(name)
+            return func(*args, **kwargs)
+        self.originals.append((module, name, func))
+        setattr(module, name, wrapper)
+
+    def count(self, name):
+        """Count a call to name."""
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def reset(self):
+        """Start counting from zero again."""
+        self.counts = {}
+
+    def remove(self):
+        """Restore the original functions."""
+        for module, name, func in reversed(self.originals):
+            setattr(module, name, func)
+        self.originals = []
+
+
+def countentries(dir):
+    """Return the number of entries in the tree at dir."""
+    total = 0
+    for _, dirnames, filenames in os.walk(dir):
+        total += len(dirnames) + len(filenames)
+    return total
+
+
+def report(phase, seconds, entries, counter):
+    """Print the results of a phase of the benchmark."""
+    rate = entries / seconds if seconds else 0
+    print "%-10s %10.3f s %10d entries %12.1f entries/s" % (
+        phase, seconds, entries, rate)
+    calls = sorted(counter.counts.items())
+    if calls and entries:
+        print "%10s %s" % ("", ", ".join(
+            "%s %.2f" % (name, float(count) / entries)
+            for name, count in calls))
+
+
+def benchmark(src, dst, jobs=1):
+    """Benchmark copying the volume src to dst, which must be empty.
+
+    Times the copy of the first snapshot of each host by the
+    CopyInitialVisitor, the copies of the rest by the CopyBackupVisitor,
+    and finding the changes between consecutive snapshots, reporting the
+    number of calls per entry made to each file system function.
+    """
+    srcdb = os.path.join(src, 'Backups.backupdb')
+    dstdb = os.path.join(dst, 'Backups.backupdb')
+    counter = CallCounter()
+    try:
+        for host in timecopy.listhosts(srcdb):
+            srchost = os.path.join(srcdb, host)
+            dsthost = os.path.join(dstdb, host)
+            os.makedirs(dsthost)
+            statedir = os.path.join(dst, '.timecopy', host)
+            os.makedirs(statedir)
+            index = timecopy.InodeIndex(os.path.join(statedir, 'inodes.db'),
+                                        dsthost)
+            pool = timecopy.CopyPool(jobs)
+            snapshots = timecopy.listsnapshots(srchost)
+            print "Host %s, %d snapshots" % (host, len(snapshots))
+            prev = None
+            totals = {}
+            for entry in snapshots:
+                srcbkup = os.path.join(srchost, entry)
+                dstbkup = os.path.join(dsthost, entry)
+                os.mkdir(dstbkup)
+                if prev is None:
+                    phase = 'initial'
+                    visitor = timecopy.CopyInitialVisitor(
+                        False, False, False, pool, None, index)
+                else:
+                    phase = 'backup'
+                    visitor = timecopy.CopyBackupVisitor(
+                        os.path.join(srchost, prev), prev, entry, False,
+                        False, False, pool, None, index)
+                entries = countentries(srcbkup)
+                counter.reset()
+                started = time.time()
+                visitor.copytree(srcbkup, dstbkup)
+                index.commit()
+                report(phase, time.time() - started, entries, counter)
+                if prev is not None:
+                    counter.reset()
+                    started = time.time()
+                    changes = sum(1 for _ in timecopy.iter_changes(
+                        os.path.join(srchost, prev), srcbkup))
+                    report('changes', time.time() - started, entries,
+                           counter)
+                    totals['changed'] = totals.get('changed', 0) + changes
+                prev = entry
+            pool.close()
+            index.close()
+            print "%d entries changed in all" % totals.get('changed', 0)
+    finally:
+        counter.remove()
+    timecopy.copier.report()
+    timecopy.runstats.report()
+
+
+def usage():
+    """Display a usage summary."""
+    print """Usage: timebench.py generate [-s N] [-f N] [-c FRACTION]
+                   [--sizes MIN:MAX] [--links FRACTION]
+                   [--xattrs FRACTION] [--seed N] <target>
+       timebench.py run [-j N] [-k] [-o DIR] <source>
+
+The 'generate' command builds a synthetic Time Machine volume in <target>,
+which must not exist yet, such as can be copied by timecopy.py on any
+system, whether or not it supports hard links to directories.
+
+The 'run' command copies the volume at <source> (generated or otherwise)
+to a temporary directory, timing the copy of each snapshot, as well as
+finding the changes between snapshots, and counting the calls made to
+each file system function for every entry in the snapshot.
+
+-c|--churn FRACTION
+\tFraction of the files that are modified in each snapshot after the
+\tfirst (default 0.05); half as many files are removed and added.
+
+-f|--files N
+\tNumber of files in each snapshot (default 10000).
+
+-h|--help
+\tPrints this usage information.
+
+-j|--jobs N
+\tCopy up to N files at the same time (default 1).
+
+-k|--keep
+\tKeep the copy, rather than removing it when done.
+
+--links FRACTION
+\tFraction of the new files that are hard links to another new file
+\tin the same snapshot (default 0.05).
+
+-o|--output DIR
+\tCopy to a temporary directory within DIR (default is the directory
+\tcontaining the <source>, so that both are on the same volume).
+
+-s|--snapshots N
+\tNumber of snapshots (default 5).
+
+--seed N
+\tSeed for the random choices, for generating the same volume again
+\t(default 0); the contents of the files are random regardless.
+
+--sizes MIN:MAX
+\tRange of file sizes in bytes (default 0:1048576), evenly distributed
+\ton a log scale, such that small files are as common as in practice.
+
+--xattrs FRACTION
+\tFraction of the new files that have an extended attribute (default
+\t0.1)."""
+
+
+def main():
+    """Parse command line arguments and do the work."""
+    shortopts = "c:f:hj:ko:s:"
+    longopts = ["churn=", "files=", "help", "jobs=", "keep", "links=",
+                "output=", "seed=", "sizes=", "snapshots=", "xattrs="]
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], shortopts, longopts)
+    except getopt.GetoptError, err:
+        print str(err)
+        print "Invoke with -h for help."
+        sys.exit(2)
+    params = {}
+    seed = 0
+    jobs = 1
+    keep = False
+    output = None
+    try:
+        for opt, val in opts:
+            if opt in ("-c", "--churn"):
+                params['churn'] = float(val)
+            elif opt in ("-f", "--files"):
+                params['files'] = int(val)
+            elif opt in ("-h", "--help"):
+                usage()
+                sys.exit()
+            elif opt in ("-j", "--jobs"):
+                jobs = int(val)
+            elif opt in ("-k", "--keep"):
+                keep = True
+            elif opt == '--links':
+                params['links'] = float(val)
+            elif opt in ("-o", "--output"):
+                output = val
+            elif opt in ("-s", "--snapshots"):
+                params['snapshots'] = int(val)
+            elif opt == '--seed':
+                seed = int(val)
+            elif opt == '--sizes':
+                low, high = val.split(':')
+                params['minsize'] = int(low)
+                params['maxsize'] = int(high)
+            elif opt == '--xattrs':
+                params['xattrs'] = float(val)
+            else:
+                assert False, "unhandled option: %s" % opt
+    except ValueError:
+        print "Invalid value for %s: %s" % (opt, val)
+        sys.exit(2)
+    if len(args) != 2 or args[0] not in ('generate', 'run'):
+        print "Missing required arguments. Invoke with -h for help."
+        sys.exit(2)
+    command, path = args
+    if command == 'generate':
+        if os.path.exists(path):
+            print "%s already exists!" % path
+            sys.exit(1)
+        Generator(path, seed=seed).generate(**params)
+        return
+    if not os.path.isdir(os.path.join(path, 'Backups.backupdb')):
+        print "%s does not contain a Time Machine backup!" % path
+        sys.exit(1)
+    if output is None:
+        output = os.path.dirname(os.path.abspath(path))
+    dst = tempfile.mkdtemp(prefix='timebench', dir=output)
+    try:
+        benchmark(path, dst, jobs)
+    except KeyboardInterrupt:
+        print "Exiting..."
+        sys.exit(1)
+    finally:
+        if keep:
+            print "Copy kept in %s" % dst
+        else:
+            shutil.rmtree(dst)
+
+
+if __name__ == '__main__':
+    main()
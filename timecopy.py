@@ -23,76 +23,684 @@ what it does and how you can use it.
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import calendar
+import collections
+import cPickle
+import ctypes
 import errno
 import getopt
+import hashlib
+import heapq
+import io
+import json
+import mmap
+import multiprocessing
 import os
 import os.path
+import Queue
+import random
 import re
 import shutil
+import sqlite3
 import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+import traceback
 import xattr
 import xattr.constants
 
-#
-# TODO: "too many open files" says get_tm_bandsize() on server the last time I tried using this
-#
+# Prefer scandir (built into Python 3.5+, or the 'scandir' backport for
+# Python 2) to read directories, falling back to listdir when absent.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# The C library, for the kernel copy calls that Python 2 does not wrap.
+try:
+    libc = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    libc = None
+
+
+class RunStats:
+    """Collects statistics on what has been done and how long it took.
+
+    Counts the entries (and bytes) for each kind of action taken, and for
+    each kind of operation on the file system, the number of calls, the
+    time they took in total, and a histogram of their latency. When given
+    a file by open(), the statistics are written to it as JSON, one object
+    per line, periodically and for each snapshot, with a final summary.
+    """
+
+    # Number of histogram buckets; bucket i counts operations that took
+    # less than 2**i microseconds (the last also counts any slower).
+    BUCKETS = 32
+
+    def __init__(self):
+        """Initialize a RunStats."""
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.actions = {}
+        self.latency = {}
+        self.output = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def count(self, action, size=0):
+        """Count an entry (of size bytes) for which action was taken."""
+        with self.lock:
+            totals = self.actions.get(action)
+            if totals is None:
+                totals = self.actions[action] = [0, 0]
+            totals[0] += 1
+            totals[1] += size
+
+    def record(self, op, seconds):
+        """Record that a single op took the given number of seconds."""
+        bucket = min(int(seconds * 1000000).bit_length(), self.BUCKETS - 1)
+        with self.lock:
+            latency = self.latency.get(op)
+            if latency is None:
+                latency = [0, 0.0, 0.0, [0] * self.BUCKETS]
+                self.latency[op] = latency
+            latency[0] += 1
+            latency[1] += seconds
+            latency[2] = max(latency[2], seconds)
+            latency[3][bucket] += 1
+
+    def timing(self, op):
+        """Return a context manager that records the time taken for op."""
+        return OpTimer(self, op)
+
+    def open(self, path, interval=10):
+        """Write the statistics to path every interval seconds."""
+        self.output = open(path, 'a')
+        self.thread = threading.Thread(target=self._writer, args=(interval,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def snapshot(self, host, name, started, before):
+        """Write the statistics for a snapshot that was just copied.
+
+        started is the time the copy began, and before the result of
+        totals() at that time.
+        """
+        after = self.totals()
+        actions = {}
+        for action, (count, size) in after.items():
+            prior = before.get(action, (0, 0))
+            if count != prior[0]:
+                actions[action] = {'count': count - prior[0],
+                                   'bytes': size - prior[1]}
+        self._write({'type': 'snapshot', 'host': host, 'snapshot': name,
+                     'seconds': time.time() - started, 'actions': actions})
+
+    def totals(self):
+        """Return a copy of the counts for each action."""
+        with self.lock:
+            return dict((action, tuple(totals))
+                        for action, totals in self.actions.items())
+
+    def summary(self, kind='progress'):
+        """Return the statistics collected so far as a dictionary."""
+        with self.lock:
+            actions = dict((action, {'count': count, 'bytes': size})
+                           for action, (count, size) in self.actions.items())
+            latency = dict((op, {'count': count, 'seconds': total,
+                                 'max': longest, 'histogram': list(buckets)})
+                           for op, (count, total, longest, buckets)
+                           in self.latency.items())
+        return {'type': kind, 'time': time.time(),
+                'elapsed': time.time() - self.started,
+                'actions': actions, 'latency': latency}
+
+    def report(self):
+        """Print a summary of the statistics, and write the final record."""
+        summary = self.summary('summary')
+        for action in sorted(summary['actions']):
+            totals = summary['actions'][action]
+            print "%-10s %10d entries %16d bytes" % (
+                action, totals['count'], totals['bytes'])
+        for op in sorted(summary['latency']):
+            latency = summary['latency'][op]
+            print "%-10s %10d calls %10.3f ms avg %10.3f ms max" % (
+                op, latency['count'],
+                latency['seconds'] * 1000 / latency['count'],
+                latency['max'] * 1000)
+        if self.output is not None:
+            self.stopped.set()
+            self.thread.join()
+            self._write(summary)
+            self.output.close()
+            self.output = None
+
+    def _write(self, record):
+        if self.output is not None:
+            with self.lock:
+                self.output.write(json.dumps(record, sort_keys=True) + '\n')
+                self.output.flush()
+
+    def _writer(self, interval):
+        while not self.stopped.wait(interval):
+            self._write(self.summary())
+
+
+class OpTimer:
+    """Context manager that records how long an operation took."""
+
+    def __init__(self, runstats, op):
+        """Initialize an OpTimer for op, recorded in runstats."""
+        self.runstats = runstats
+        self.op = op
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, *exc_info):
+        self.runstats.record(self.op, time.time() - self.started)
+
+
+runstats = RunStats()
+
+# Number of bytes copied taking as long as creating a single entry.
+ENTRY_BYTES = 64 * 1024
+
+
+def workdone(totals):
+    """Return the work done, as counted in totals (from runstats).
+
+    That is the bytes copied, plus ENTRY_BYTES for each entry created, so
+    as to account for the time spent on the metadata.
+    """
+    work = totals.get('copied', (0, 0))[1]
+    for action in ('copied', 'linked', 'symlinked', 'dirs'):
+        work += ENTRY_BYTES * totals.get(action, (0, 0))[0]
+    return work
+
+
+def error(e, path, what='processing'):
+    """Report an error that occurred while processing path."""
+    print "ERROR '{}' {} {}".format(e, what, path)
+    runstats.count('errors')
+
+
+def errorcount():
+    """Return the number of errors reported so far."""
+    return runstats.totals().get('errors', (0, 0))[0]
+
+
+class Throttle:
+    """Limits the rate at which something is done.
+
+    Each call to wait() takes some amount from a bucket that refills at
+    the given rate, up to one second's worth; callers that overdraw the
+    bucket sleep until it would have refilled, so that concurrent callers
+    share the rate between them. With a rate of zero, there is no limit.
+    """
+
+    def __init__(self, rate=0):
+        """Initialize a Throttle limited to rate per second."""
+        self.lock = threading.Lock()
+        self.setrate(rate)
+
+    def setrate(self, rate):
+        """Change the limit to rate per second."""
+        with self.lock:
+            self.rate = rate
+            self.tokens = rate
+            self.stamp = time.time()
+
+    def wait(self, amount=1):
+        """Wait until amount more can be done within the limit."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            delay = -self.tokens / float(self.rate) if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+# Limits the bytes copied, and the metadata operations performed, per second.
+bytethrottle = Throttle()
+opthrottle = Throttle()
 
 
 class TreeVisitor:
 
     """Visitor pattern for visitfiles function.
 
-    As tree is traversed, methods of the visitor are invoked.
+    As tree is traversed, methods of the visitor are invoked. Each method
+    receives the path of the entry and the result of lstat() on that entry,
+    so visitors never need to stat the source entry again.
     """
 
-    def dir(self, dir):
-        """A directory has been encountered."""
+    def startdir(self, dir):
+        """The contents of a directory are about to be visited."""
+        pass
+
+    def dir(self, dir, stats):
+        """A directory has been encountered.
+
+        Return True to have the contents of the directory visited.
+        """
+        return True
+
+    def enddir(self, dir, stats):
+        """All of the contents of a visited directory have been visited."""
         pass
 
-    def file(self, file):
+    def file(self, file, stats):
         """A file has been encountered."""
         pass
 
-    def link(self, link):
+    def link(self, link, stats):
         """A symbolic link has been encountered."""
         pass
 
 
-def visitfiles(dir, visitor):
-    """Calls the visitor for each entry encountered in the directory."""
-    for entry in os.listdir(dir):
-        pathname = os.path.join(dir, entry)
+def listentries(dir):
+    """Return a list of (pathname, stats) tuples for the entries in dir.
+
+    Each entry is stat'd exactly once, without following symbolic links.
+    The directory is read to completion and closed before returning, such
+    that only one directory handle is ever open, no matter how deep the
+    tree may be.
+    """
+    entries = []
+    if scandir is None:
+        for name in os.listdir(dir):
+            pathname = os.path.join(dir, name)
+            started = time.time()
+            try:
+                entries.append((pathname, os.lstat(pathname)))
+            except OSError, e:
+                error(e, pathname)
+            runstats.record('lstat', time.time() - started)
+        return entries
+    it = scandir(dir)
+    try:
+        for entry in it:
+            started = time.time()
+            try:
+                entries.append((entry.path, entry.stat(follow_symlinks=False)))
+            except OSError, e:
+                error(e, entry.path)
+            runstats.record('lstat', time.time() - started)
+    finally:
+        # Only the newer scandir iterators can be closed explicitly.
+        if hasattr(it, 'close'):
+            it.close()
+    return entries
+
+
+def visitfiles(dir, visitor, pathfilter=None):
+    """Calls the visitor for each entry encountered in the directory tree.
+
+    The tree is traversed depth-first using an explicit stack, rather than
+    recursion, so arbitrarily deep trees can be visited. Subdirectories are
+    only descended into when visitor.dir() returns True, after which
+    visitor.enddir() is called once everything below them has been visited.
+    Entries that pathfilter (if any) excludes, by their path relative to
+    dir, are skipped altogether, and excluded directories never listed.
+    """
+    if pathfilter is not None and not pathfilter.active:
+        pathfilter = None
+    # The stack holds directories to be listed (strings) and directories
+    # whose contents have all been visited ((pathname, stats) tuples).
+    stack = [dir]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, tuple):
+            try:
+                visitor.enddir(*item)
+            except OSError, e:
+                error(e, item[0])
+            continue
         try:
-            mode = os.lstat(pathname)[stat.ST_MODE]
-            if stat.S_ISDIR(mode):
-                visitor.dir(pathname)
-            elif stat.S_ISLNK(mode):
-                visitor.link(pathname)
-            elif stat.S_ISREG(mode):
-                visitor.file(pathname)
-            else:
-                print 'WARNING: unknown file %s' % pathname
+            visitor.startdir(item)
+            entries = listentries(item)
         except OSError, e:
-            print "ERROR '{}' processing {}".format(e, pathname)
+            error(e, item)
+            continue
+        subdirs = []
+        for pathname, stats in entries:
+            try:
+                mode = stat.S_IFMT(stats[stat.ST_MODE])
+                if pathfilter is not None and pathfilter.excluded(
+                        pathname[len(dir):], mode == stat.S_IFDIR):
+                    continue
+                if stat.S_ISDIR(mode):
+                    if visitor.dir(pathname, stats):
+                        subdirs.append((pathname, stats))
+                elif stat.S_ISLNK(mode):
+                    visitor.link(pathname, stats)
+                elif stat.S_ISREG(mode):
+                    visitor.file(pathname, stats)
+                else:
+                    print 'WARNING: unknown file %s' % pathname
+            except OSError, e:
+                error(e, pathname)
+        # Push in reverse so that directories are visited in listing order.
+        for subdir in reversed(subdirs):
+            stack.append(subdir)
+            stack.append(subdir[0])
+
+
+class PathFilter:
+    """Decides which entries of each snapshot to leave out of the copy.
+
+    The rules are matched against the path of each entry relative to the
+    root of its snapshot (e.g. /Macintosh HD/Users/me/.Trash), and so
+    apply the same way in every snapshot. Literal paths are held in a set
+    and a trie of path components, and all of the glob patterns are
+    compiled into a single regular expression, such that checking an
+    entry costs much the same no matter how many rules there are.
+    """
+
+    def __init__(self):
+        """Initialize a PathFilter that leaves nothing out."""
+        self.included = {}
+        self.paths = {}
+        self.patterns = {False: [], True: []}
+        self.regexes = {False: None, True: None}
+        self.active = False
+
+    def include(self, path):
+        """Leave out everything that is neither within nor above path.
+
+        path is a literal path (with no glob characters) starting with a
+        slash. Returns False if it is not.
+        """
+        if not path.startswith('/') or re.search(r'[*?[]', path):
+            return False
+        node = self.included
+        for part in path.strip('/').split('/'):
+            node = node.setdefault(part, {})
+        # None marks the end of an included path.
+        node[None] = True
+        self.active = True
+        return True
+
+    def exclude(self, pattern):
+        """Leave out the entries matching pattern.
+
+        A pattern with no slash matches the name of an entry at any depth
+        (e.g. '.Trash' or '*.tmp'), and any other matches the whole path,
+        anchored at the root of the snapshot. '*' and '?' match within a
+        single component, and '**' across any number of them. A trailing
+        slash matches only directories.
+        """
+        dironly = pattern.endswith('/') and len(pattern) > 1
+        pattern = pattern.rstrip('/') or '/'
+        if '/' in pattern and not pattern.startswith('/'):
+            pattern = '/' + pattern
+        if not re.search(r'[*?[]', pattern) and pattern.startswith('/'):
+            # Plain paths need not go through the regular expression.
+            self.paths[pattern] = self.paths.get(pattern, True) and dironly
+        else:
+            regex = globregex(pattern)
+            if not pattern.startswith('/'):
+                regex = '.*/' + regex
+            self.patterns[dironly].append(regex)
+            self.regexes[dironly] = re.compile('(?:%s)\\Z' % ')\\Z|(?:'.join(
+                self.patterns[dironly]), re.DOTALL)
+        self.active = True
+
+    def excluded(self, relpath, isdir):
+        """Return True if the entry at relpath is to be left out."""
+        if self.included and not self._within(relpath, isdir):
+            return True
+        dironly = self.paths.get(relpath)
+        if dironly is not None and (isdir or not dironly):
+            return True
+        if self.regexes[False] and self.regexes[False].match(relpath):
+            return True
+        if isdir and self.regexes[True] and self.regexes[True].match(relpath):
+            return True
+        return False
+
+    def _within(self, relpath, isdir):
+        """Return True if relpath is within or above an included path."""
+        node = self.included
+        for part in relpath.strip('/').split('/'):
+            if None in node:
+                return True
+            node = node.get(part)
+            if node is None:
+                return False
+        return isdir or None in node
+
+    def read(self, path):
+        """Add the rules in the file at path, one per line.
+
+        Lines starting with '+ ' are included paths, and blank lines and
+        those starting with '#' are ignored; the rest are excluded.
+        Returns the first line that is not a valid rule, or None.
+        """
+        with open(path) as fobj:
+            for line in fobj:
+                line = line.rstrip('\r\n')
+                if not line.strip() or line.startswith('#'):
+                    continue
+                if line.startswith('+ '):
+                    if not self.include(line[2:]):
+                        return line
+                else:
+                    self.exclude(line)
+        return None
+
+
+def globregex(pattern):
+    """Return the regular expression for the glob pattern."""
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('/**/', i):
+            # Any number of directories, including none at all.
+            regex.append('(?:/.*)?/')
+            i += 4
+            continue
+        if pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        if char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '[':
+            end = pattern.find(']', i + 2)
+            if end < 0:
+                regex.append('\\[')
+            else:
+                inner = pattern[i + 1:end]
+                if inner.startswith('!'):
+                    inner = '^' + inner[1:]
+                regex.append('[%s]' % inner.replace('\\', '\\\\'))
+                i = end
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return ''.join(regex)
+
+
+# The rules for leaving entries out of the copy, as given on the command line.
+pathrules = PathFilter()
+
+
+def copystat(stats, dst, fd=None):
+    """Copy the permissions, flags, and times in stats to dst.
+
+    Equivalent to shutil.copystat() but uses the source stats that were
+    already collected, rather than calling stat() on the source again.
+    If fd is the open file descriptor for dst, it is used where possible.
+    """
+    opthrottle.wait()
+    with runstats.timing('copystat'):
+        if fd is None:
+            os.chmod(dst, stat.S_IMODE(stats[stat.ST_MODE]))
+        else:
+            os.fchmod(fd, stat.S_IMODE(stats[stat.ST_MODE]))
+        times = (stats[stat.ST_ATIME], stats[stat.ST_MTIME])
+        if fd is not None and os.utime in getattr(os, 'supports_fd', ()):
+            os.utime(fd, times)
+        else:
+            os.utime(dst, times)
+        if hasattr(os, 'chflags') and getattr(stats, 'st_flags', 0):
+            try:
+                os.chflags(dst, stats.st_flags)
+            except OSError, e:
+                if getattr(errno, 'EOPNOTSUPP', None) != e.errno:
+                    raise e
+
+
+class FixupQueue:
+    """Holds the changes of ownership that failed, to be retried later.
+
+    Rather than stalling the copy, each failure is queued and retried in a
+    batch, with exponential back-off, at the end of the snapshot. If the
+    first few changes of ownership do not take effect, or fail before any
+    has succeeded, or every one that is retried fails, the target is taken
+    to ignore ownership and no more are attempted, as with --nochown.
+    """
+
+    # Number of changes of ownership checked to detect ignored ownership.
+    PROBES = 3
+    # Number of times the queue is retried, and the delay before the first.
+    RETRIES = 4
+    BACKOFF = 0.5
+
+    def __init__(self):
+        """Initialize an empty FixupQueue."""
+        self.lock = threading.Lock()
+        self.pending = []
+        self.probes = 0
+        self.ignored = 0
+        self.refused = 0
+        self.changed = False
+        self.disabled = False
+        self.fixed = 0
+        self.abandoned = 0
+
+    def disable(self, reason):
+        """Stop changing ownership, dropping the queued changes."""
+        with self.lock:
+            if self.disabled:
+                return
+            self.disabled = True
+            self.pending = []
+        print "Target %s ownership, no longer changing it" % reason
+
+    def probe(self, path, uid, gid):
+        """Check that the ownership of path (not a link) was changed."""
+        with self.lock:
+            if self.probes >= self.PROBES:
+                return
+            self.probes += 1
+        stats = os.lstat(path)
+        if stats[stat.ST_UID] != uid or stats[stat.ST_GID] != gid:
+            with self.lock:
+                self.ignored += 1
+        if self.ignored == self.PROBES:
+            self.disable('ignores')
+
+    def defer(self, path, uid, gid, isdir=False):
+        """Queue the change of ownership of path to be retried later.
+
+        Directories sometimes fail to change for no lasting reason, so only
+        other entries count towards deciding that the target refuses.
+        """
+        with self.lock:
+            if self.disabled:
+                return
+            self.pending.append((path, uid, gid))
+            if not self.changed and not isdir:
+                self.refused += 1
+        if self.refused >= self.PROBES and not self.changed:
+            # Not one has succeeded, so they are likely all to fail.
+            self.disable('refuses')
+
+    def retry(self):
+        """Retry the queued changes, abandoning those that keep failing."""
+        delay = self.BACKOFF
+        for attempt in range(self.RETRIES):
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return
+            time.sleep(delay)
+            delay *= 2
+            failed = []
+            for path, uid, gid in pending:
+                try:
+                    opthrottle.wait()
+                    with runstats.timing('chown'):
+                        os.lchown(path, uid, gid)
+                    runstats.count('fixed')
+                    with self.lock:
+                        self.fixed += 1
+                except OSError:
+                    failed.append((path, uid, gid))
+            with self.lock:
+                self.pending.extend(failed)
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.abandoned += len(pending)
+        for path, uid, gid in pending:
+            runstats.count('abandoned')
+        if not self.fixed and self.abandoned >= self.PROBES:
+            self.disable('refuses')
+            return
+        for path, uid, gid in pending:
+            print "WARNING: cannot chown %s" % path
+
+    def report(self):
+        """Print how many changes of ownership were retried."""
+        if self.fixed or self.abandoned:
+            print "Fixed ownership of %d entries, abandoned %d" % (
+                self.fixed, self.abandoned)
+
+
+fixups = FixupQueue()
 
 
 def chown(path, uid, gid):
     """Attempt to change the owner/group of the given file/directory.
 
-    Uses os.lchown(). If this fails due to insufficient permissions, display
-    an appropriate error message and exit. Otherwise, raise the error.
+    Uses os.lchown(). If this fails due to insufficient permissions, the
+    change is queued in fixups, to be retried at the end of the snapshot.
+    Otherwise, raise the error.
     """
+    if fixups.disabled:
+        return
     try:
         # Use lchown so we do not follow symbolic links, just change the
         # target as specified by the caller.
-        os.lchown(path, uid, gid)
+        opthrottle.wait()
+        with runstats.timing('chown'):
+            os.lchown(path, uid, gid)
+        fixups.changed = True
         # Note that it is possible the destination volume was mounted with
         # the MNT_IGNORE_OWNERSHIP flag, in which case everything we create
         # there will be owned by the _unknown user and group, no matter what
         # we might want it to be. This is built into the XNU kernel.
+        if fixups.probes < fixups.PROBES and \
+                not stat.S_ISLNK(os.lstat(path)[stat.ST_MODE]):
+            fixups.probe(path, uid, gid)
     except OSError, e:
         if e.errno == errno.EPERM:
             # Strangely root has problems changing symlinks that point
@@ -101,119 +709,2126 @@ def chown(path, uid, gid):
             # in which case all files are owned by the _unknown user).
             mode = os.lstat(path)[stat.ST_MODE]
             if not stat.S_ISLNK(mode):
-                # Sometimes mysteriously fails to chown directories.
-                # Try again in one second; if it fails again ignore
-                # the problem and move on.
-                time.sleep(1)
-                try:
-                    os.chown(path, uid, gid)
-                except OSError:
-                    pass
+                # Sometimes mysteriously fails to chown directories,
+                # so try again later rather than holding up the copy.
+                fixups.defer(path, uid, gid, stat.S_ISDIR(mode))
         else:
             raise e
 
 
+def fchown(fd, path, uid, gid):
+    """Attempt to change the owner/group of the file open as fd.
+
+    If this fails due to insufficient permissions, falls back to chown()
+    using the path, which deals with the various special cases.
+    """
+    if fixups.disabled:
+        return
+    try:
+        opthrottle.wait()
+        with runstats.timing('chown'):
+            os.fchown(fd, uid, gid)
+        fixups.changed = True
+    except OSError, e:
+        if e.errno != errno.EPERM:
+            raise e
+        chown(path, uid, gid)
+
+
 def link(src, dst):
     """Create a hard link called 'dst' that points to 'src'.
 
     Ensures that the src entry exists and raises an error if not.
     """
     if os.path.exists(src):
-        os.link(src, dst)
+        opthrottle.wait()
+        with runstats.timing('link'):
+            os.link(src, dst)
     else:
         raise OSError(errno.ENOENT, "%s missing!" % src)
 
 
+class FileCopier:
+    """Copies the contents of files using the fastest means available.
+
+    The kernel-side copy_file_range() and sendfile() on Linux, or
+    fcopyfile() on Mac OS X, are tried first, called through ctypes when
+    the C library provides them, followed by a read/write loop using a
+    large, reusable buffer. A mechanism that reports it is not supported
+    for the source and target volumes is not tried again. The number of
+    files and bytes copied by each mechanism is recorded for reporting.
+
+    Sparse files, those with fewer blocks allocated than their size calls
+    for, are copied one extent of data at a time, as found by lseek() with
+    SEEK_DATA and SEEK_HOLE, such that the holes are neither read nor
+    written, leaving the same holes in the copy.
+    """
+
+    # Size of the buffer used in the read/write loop.
+    BUFSIZE = 1024 * 1024
+
+    # Errors indicating that a kernel copy mechanism is not supported.
+    UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EBADF,
+                   getattr(errno, 'ENOTSUP', errno.EINVAL),
+                   getattr(errno, 'EOPNOTSUPP', errno.EINVAL))
+
+    # Python 2 lacks these; Linux differs from Mac OS X and the BSDs.
+    if sys.platform.startswith('linux'):
+        SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+        SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+    else:
+        SEEK_DATA = getattr(os, 'SEEK_DATA', 4)
+        SEEK_HOLE = getattr(os, 'SEEK_HOLE', 3)
+
+    # Flag to fcopyfile() to copy just the data, not the metadata.
+    COPYFILE_DATA = 1 << 3
+
+    def __init__(self):
+        """Initialize a FileCopier."""
+        self.backends = []
+        if sys.platform.startswith('linux'):
+            func = getattr(libc, 'copy_file_range', None)
+            if func is not None:
+                # Null offsets use (and advance) those of the files.
+                func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                 ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.c_uint]
+                func.restype = ctypes.c_ssize_t
+                self.backends.append(('copy_file_range',
+                                      self._copy_file_range))
+            func = getattr(libc, 'sendfile', None)
+            if func is not None:
+                # Only Linux supports sendfile() between regular files.
+                func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_size_t]
+                func.restype = ctypes.c_ssize_t
+                self.backends.append(('sendfile', self._sendfile))
+        elif sys.platform == 'darwin':
+            func = getattr(libc, 'fcopyfile', None)
+            if func is not None:
+                func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_uint32]
+                func.restype = ctypes.c_int
+                self.backends.append(('fcopyfile', self._fcopyfile))
+        self.backends.append(('readinto', self._readinto))
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.seekdata = True
+        self.holes = 0
+        self.zeros = None
+
+    def copy(self, src, dst, stats=None, sha=None):
+        """Copy the contents of src to dst, returning the mechanism used.
+
+        If stats (from lstat() of src) is given, the metadata of src is
+        copied as well, by way of copymeta(), while the files are open.
+        If sha (a hashlib object) is given, it is updated with the contents.
+        Sparse files are copied as such only when stats is given.
+        """
+        if sha is None:
+            backends = list(self.backends)
+        else:
+            # Only the read/write loop sees the contents to digest them.
+            backends = [('readinto', lambda fsrc, fdst:
+                         self._readinto(fsrc, fdst, sha))]
+        with io.open(src, 'rb', buffering=0) as fsrc:
+            with io.open(dst, 'wb', buffering=0) as fdst:
+                started = time.time()
+                count = None
+                if stats is not None and self.seekdata and \
+                        getattr(stats, 'st_blocks', None) is not None and \
+                        stats.st_blocks * 512 < stats[stat.ST_SIZE]:
+                    name = 'sparse'
+                    count = self._sparse(fsrc, fdst, stats[stat.ST_SIZE], sha)
+                for name, func in backends if count is None else ():
+                    try:
+                        count = func(fsrc, fdst)
+                        break
+                    except (IOError, OSError), e:
+                        # Fall back only if nothing has been written yet.
+                        if e.errno not in self.UNSUPPORTED or fdst.tell() \
+                                or name == 'readinto':
+                            raise e
+                        with self.lock:
+                            if (name, func) in self.backends:
+                                self.backends.remove((name, func))
+                runstats.record('copy', time.time() - started)
+                if stats is not None:
+                    copymeta(fsrc, fdst, dst, stats)
+        with self.lock:
+            totals = self.totals.setdefault(name, [0, 0])
+            totals[0] += 1
+            totals[1] += count
+            if name == 'sparse':
+                self.holes += stats[stat.ST_SIZE] - count
+        if name == 'sparse':
+            runstats.count('sparse', stats[stat.ST_SIZE] - count)
+        return name
+
+    def report(self):
+        """Print the number of files and bytes copied by each mechanism."""
+        for name in sorted(self.totals):
+            files, count = self.totals[name]
+            print "Copied %d files (%d bytes) using %s" % (files, count, name)
+        if self.holes:
+            files, count = self.totals['sparse']
+            print "Left holes in %d sparse files (%d of %d bytes saved)" % (
+                files, self.holes, self.holes + count)
+
+    def _chunk(self):
+        # Copy less at a time when limited, so as to keep a steady pace.
+        return self.BUFSIZE if bytethrottle.rate else self.BUFSIZE * 64
+
+    def _check(self, result):
+        # Raise the error for the C library call that returned -1.
+        if result < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return result
+
+    def _copy_file_range(self, fsrc, fdst):
+        total = 0
+        while True:
+            count = self._check(libc.copy_file_range(
+                fsrc.fileno(), None, fdst.fileno(), None, self._chunk(), 0))
+            if not count:
+                return total
+            bytethrottle.wait(count)
+            total += count
+
+    def _sendfile(self, fsrc, fdst):
+        total = 0
+        while True:
+            count = self._check(libc.sendfile(
+                fdst.fileno(), fsrc.fileno(), None, self._chunk()))
+            if not count:
+                return total
+            bytethrottle.wait(count)
+            total += count
+
+    def _fcopyfile(self, fsrc, fdst):
+        # The whole file is copied at once, and so throttled afterwards.
+        self._check(libc.fcopyfile(fsrc.fileno(), fdst.fileno(), None,
+                                   self.COPYFILE_DATA))
+        count = os.fstat(fdst.fileno()).st_size
+        bytethrottle.wait(count)
+        return count
+
+    def _sparse(self, fsrc, fdst, size, sha=None):
+        # Returns None, having done nothing, if SEEK_DATA is not supported.
+        fd = fsrc.fileno()
+        view = self._buffer()
+        total = 0
+        offset = 0
+        while offset < size:
+            try:
+                data = os.lseek(fd, offset, self.SEEK_DATA)
+            except OSError, e:
+                if e.errno == errno.ENXIO:
+                    # Nothing but a hole remains.
+                    data = size
+                elif e.errno in self.UNSUPPORTED and not offset:
+                    self.seekdata = False
+                    return None
+                else:
+                    raise e
+            hole = os.lseek(fd, data, self.SEEK_HOLE) if data < size else size
+            if sha is not None:
+                self._digestzeros(sha, data - offset)
+            fsrc.seek(data)
+            fdst.seek(data)
+            remaining = hole - data
+            while remaining:
+                count = fsrc.readinto(view[:min(remaining, len(view))])
+                if not count:
+                    break
+                fdst.write(view[:count])
+                bytethrottle.wait(count)
+                if sha is not None:
+                    sha.update(view[:count])
+                total += count
+                remaining -= count
+            offset = hole
+        # Writing nothing past the last extent leaves the file too short.
+        fdst.truncate(size)
+        return total
+
+    def _digestzeros(self, sha, count):
+        if self.zeros is None:
+            self.zeros = memoryview(bytearray(self.BUFSIZE))
+        while count > 0:
+            sha.update(self.zeros[:min(count, self.BUFSIZE)])
+            count -= self.BUFSIZE
+
+    def _buffer(self):
+        # Each worker thread reuses a buffer of its own.
+        view = getattr(self.local, 'view', None)
+        if view is None:
+            view = memoryview(bytearray(self.BUFSIZE))
+            self.local.view = view
+        return view
+
+    def _readinto(self, fsrc, fdst, sha=None):
+        view = self._buffer()
+        total = 0
+        while True:
+            count = fsrc.readinto(view)
+            if not count:
+                return total
+            fdst.write(view[:count])
+            bytethrottle.wait(count)
+            if sha is not None:
+                sha.update(view[:count])
+            total += count
+
+
+copier = FileCopier()
+
+
+def filedigest(path):
+    """Return the SHA-1 digest of the contents of path, in hexadecimal."""
+    sha = hashlib.sha1()
+    with io.open(path, 'rb') as fobj:
+        while True:
+            data = fobj.read(FileCopier.BUFSIZE)
+            if not data:
+                return sha.hexdigest()
+            sha.update(data)
+
+
 def copyxattr(src, dst):
     """Copy the extended attributes from src to dst using xattr."""
     # See http://pypi.python.org/pypi/xattr for a (possibly outdated)
     # version of xattr. A (possibly newer) version is included with
     # Python on the Mac.
+    opthrottle.wait()
     sx = xattr.xattr(src)
     dx = xattr.xattr(dst)
     # Make sure not to follow symbolic links as we always work on the
     # links themselves, not the (possibly) non-existent target.
+    started = time.time()
     attrs = sx.list(xattr.constants.XATTR_NOFOLLOW)
     try:
         for name in attrs:
             value = sx.get(name, xattr.constants.XATTR_NOFOLLOW)
             dx.set(name, value, xattr.constants.XATTR_NOFOLLOW)
+        if attrs:
+            runstats.count('xattr')
     except IOError:
         # Fails for certain directories which we will ignore.
         # All others, show a warning.
         if not dst.endswith(("/etc", "/tmp", "/var")):
             print "WARNING: cannot xattr %s" % dst
+    runstats.record('xattr', time.time() - started)
+
+
+# Distinct sets of extended attributes read so far, such that the many
+# files with identical attributes (e.g. the same Finder info) share a
+# single copy, which can then be compared by identity.
+xattrsets = {}
+
+# Maximum number of distinct sets of extended attributes to remember.
+XATTRSETS_MAX = 10000
+
+
+def readxattrs(obj, options=xattr.constants.XATTR_NOFOLLOW):
+    """Return the extended attributes of obj as a sorted tuple of pairs.
+
+    obj may be a path or a file descriptor; for the latter, options must
+    be zero. Returns an empty tuple, after a single system call, when obj
+    has no extended attributes.
+    """
+    sx = xattr.xattr(obj)
+    names = sx.list(options)
+    if not names:
+        return ()
+    attrs = tuple(sorted((name, sx.get(name, options)) for name in names))
+    shared = xattrsets.get(attrs)
+    if shared is None:
+        if len(xattrsets) >= XATTRSETS_MAX:
+            xattrsets.clear()
+        xattrsets[attrs] = shared = attrs
+    return shared
+
+
+def copymeta(fsrc, fdst, dst, stats):
+    """Copy the metadata of the open file fsrc to fdst (opened from dst).
+
+    Copies ownership, extended attributes, permissions, and times, using
+    the open file descriptors rather than resolving the paths again. The
+    attributes are read with a single call when there are none.
+    """
+    fd = fdst.fileno()
+    # Change the owner first as doing so may clear the setuid bits.
+    fchown(fd, dst, stats[stat.ST_UID], stats[stat.ST_GID])
+    started = time.time()
+    attrs = readxattrs(fsrc.fileno(), 0)
+    if attrs:
+        opthrottle.wait()
+        dx = xattr.xattr(fd)
+        try:
+            for name, value in attrs:
+                dx.set(name, value)
+            runstats.count('xattr')
+        except IOError:
+            print "WARNING: cannot xattr %s" % dst
+    runstats.record('xattr', time.time() - started)
+    copystat(stats, dst, fd)
+
+
+class CopyPool:
+    """Runs file copy jobs on a bounded set of worker threads.
+
+    Jobs are grouped by the source directory containing the entry, so that
+    work for a directory (such as setting its modification time) can be
+    deferred until all of the jobs for its children have finished. Each
+    subdirectory holds its parent until its own deferred work has run, so
+    the work for a directory happens only once its entire subtree is done.
+    With a single job, everything runs immediately on the calling thread.
+
+    Jobs may also be scheduled to run in batches of a window of jobs each,
+    sorted by a key, such as the inode number of the file to be copied.
+    On rotating disks, the inode numbers roughly follow the placement of
+    the files, so reading them in that order cuts down on seeking.
+
+    The number of jobs run at once may be limited to fewer than the number
+    of threads, such as by a Controller, with setlimit().
+    """
+
+    def __init__(self, jobs=1, window=0):
+        """Initialize a CopyPool with the given number of worker threads.
+
+        window is the number of jobs to sort in each batch of scheduled
+        jobs; if zero, scheduled jobs are submitted right away.
+        """
+        self.jobs = jobs
+        self.limit = jobs
+        self.active = 0
+        self.window = window
+        self.batch = []
+        # A small queue applies back-pressure to the traversal, which
+        # otherwise would race ahead and queue up the entire tree.
+        self.queue = Queue.Queue(maxsize=jobs * 4)
+        self.cond = threading.Condition()
+        self.outstanding = 0
+        self.pending = {}
+        self.finalizers = {}
+        self.threads = []
+        if jobs > 1:
+            for _ in range(jobs):
+                thread = threading.Thread(target=self._worker)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, dir, func, *args):
+        """Run func with args as a job belonging to directory dir."""
+        if not self.threads:
+            self._run(func, args)
+            return
+        self.hold(dir)
+        with self.cond:
+            self.outstanding += 1
+        # Use a timeout so that KeyboardInterrupt is not blocked in put().
+        while True:
+            try:
+                self.queue.put((dir, func, args), timeout=1)
+                break
+            except Queue.Full:
+                pass
+
+    def schedule(self, dir, key, func, *args):
+        """Submit func with args as a job for dir, in order of key.
+
+        The job is held back, along with the work for dir, until a window
+        of jobs has been scheduled, or flush() is called.
+        """
+        if not self.window:
+            self.submit(dir, func, *args)
+            return
+        self.hold(dir)
+        self.batch.append((key, dir, func, args))
+        if len(self.batch) >= self.window:
+            self.flush()
+
+    def flush(self):
+        """Submit the jobs held back by schedule(), sorted by key."""
+        batch = sorted(self.batch, key=lambda job: job[0])
+        self.batch = []
+        for key, dir, func, args in batch:
+            self.submit(dir, func, *args)
+            self.release(dir)
+
+    def hold(self, dir):
+        """Defer the work for directory dir until a matching release()."""
+        with self.cond:
+            self.pending[dir] = self.pending.get(dir, 0) + 1
+
+    def release(self, dir):
+        """Release a hold on dir, running its deferred work if the last.
+
+        Finishing a directory releases the hold on its parent, and so on
+        up the tree, without recursion.
+        """
+        while dir is not None:
+            with self.cond:
+                self.pending[dir] -= 1
+                if self.pending[dir]:
+                    return
+                del self.pending[dir]
+                finalizer = self.finalizers.pop(dir, None)
+            if finalizer is None:
+                return
+            dir, func, args = finalizer
+            self._run(func, args)
+
+    def finish(self, dir, parent, func, *args):
+        """Run func with args once all jobs and holds for dir are done.
+
+        Afterward the hold on parent, if not None, is released.
+        """
+        with self.cond:
+            if self.pending.get(dir):
+                self.finalizers[dir] = (parent, func, args)
+                return
+        self._run(func, args)
+        if parent is not None:
+            self.release(parent)
+
+    def setlimit(self, limit):
+        """Limit the number of jobs run at once to limit."""
+        with self.cond:
+            self.limit = limit
+            self.cond.notify_all()
+
+    def join(self):
+        """Wait for all submitted jobs (and finalizers) to complete."""
+        with self.cond:
+            while self.outstanding:
+                self.cond.wait(1)
+
+    def close(self):
+        """Wait for outstanding jobs and stop the worker threads."""
+        self.join()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except Exception, e:
+            error(e, args[0])
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            dir, func, args = item
+            with self.cond:
+                while self.active >= self.limit:
+                    self.cond.wait(1)
+                self.active += 1
+            self._run(func, args)
+            self.release(dir)
+            with self.cond:
+                self.active -= 1
+                self.outstanding -= 1
+                self.cond.notify_all()
+
+
+class Controller:
+    """Adjusts the number of jobs a CopyPool runs at once.
+
+    Every so often, the work done in the meantime (bytes copied, and
+    entries created, as counted by runstats) is compared with that done
+    in the period before. While adding (or removing) a job helps, the
+    controller keeps doing so; when that makes things worse, it goes the
+    other way; and when it makes no difference, it removes a job, so as
+    not to burden a shared target for nothing. Should the metadata
+    operations take far longer than the quickest seen so far, the target
+    is struggling, and a job is removed regardless.
+    """
+
+    # Operations on the target whose latency is watched.
+    METADATA = ('chown', 'copystat', 'link', 'xattr')
+
+    def __init__(self, pool, interval=5):
+        """Initialize a Controller for pool, adjusting every interval."""
+        self.pool = pool
+        self.interval = interval
+        self.step = 1
+        self.rate = None
+        self.fastest = None
+        self.before = self.measure()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._adjuster)
+        self.thread.daemon = True
+        pool.setlimit(1)
+
+    def start(self):
+        """Start adjusting the pool."""
+        self.thread.start()
+
+    def stop(self):
+        """Stop adjusting the pool."""
+        self.stopped.set()
+        self.thread.join()
+
+    def measure(self):
+        """Return the work done so far, and the metadata operation times."""
+        work = workdone(runstats.totals())
+        summary = runstats.summary()
+        count = 0
+        seconds = 0.0
+        for op in self.METADATA:
+            latency = summary['latency'].get(op)
+            if latency is not None:
+                count += latency['count']
+                seconds += latency['seconds']
+        return time.time(), work, count, seconds
+
+    def adjust(self):
+        """Measure the work done since last time, and adjust the pool."""
+        after = self.measure()
+        elapsed, work, count, seconds = [
+            now - then for now, then in zip(after, self.before)]
+        self.before = after
+        if not work or elapsed <= 0:
+            # Nothing to go by, such as while only comparing snapshots.
+            return
+        rate = work / elapsed
+        step = self.step
+        if self.rate is not None:
+            if rate < self.rate * 0.95:
+                step = -self.step
+            elif rate <= self.rate * 1.05:
+                step = -1
+        if count:
+            latency = seconds / count
+            if self.fastest is None or latency < self.fastest:
+                self.fastest = latency
+            # The target struggling overrides whatever the rate suggests.
+            if latency > self.fastest * 4:
+                step = -1
+        self.rate = rate
+        self.step = step
+        limit = max(1, min(self.pool.jobs, self.pool.limit + step))
+        self.pool.setlimit(limit)
+
+    def _adjuster(self):
+        while not self.stopped.wait(self.interval):
+            self.adjust()
+
+
+class Journal:
+    """Records the progress made copying a single snapshot.
+
+    The relative path of each entry is appended to the journal once it has
+    been completely copied (for directories, once everything within them
+    has been copied), such that an interrupted copy can later resume where
+    it left off. When the entire snapshot has been copied, the journal is
+    replaced by a small marker file recording that the copy is complete.
+    """
+
+    def __init__(self, statedir, snapshot):
+        """Initialize a Journal for snapshot, kept in statedir."""
+        self.path = os.path.join(statedir, snapshot + '.journal')
+        self.marker = os.path.join(statedir, snapshot + '.complete')
+        self.lock = threading.Lock()
+        self.done = set()
+        self.resuming = os.path.exists(self.path)
+        if self.resuming:
+            with open(self.path, 'rb') as fobj:
+                for line in fobj:
+                    # Ignore a partially written line at the end.
+                    if line.endswith('\n'):
+                        self.done.add(self._unescape(line[:-1]))
+        self.fobj = None
+
+    def iscomplete(self):
+        """Return True if the snapshot has been completely copied."""
+        return os.path.exists(self.marker)
+
+    def start(self):
+        """Create the journal, if it does not already exist."""
+        with self.lock:
+            if self.fobj is None:
+                self.fobj = open(self.path, 'ab')
+
+    def isdone(self, relpath):
+        """Return True if the entry at relpath was already copied."""
+        return relpath in self.done
+
+    def record(self, relpath):
+        """Record that the entry at relpath has been copied."""
+        line = self._escape(relpath) + '\n'
+        with self.lock:
+            if self.fobj is None:
+                self.fobj = open(self.path, 'ab')
+            self.fobj.write(line)
+            self.fobj.flush()
+
+    def complete(self):
+        """Mark the snapshot as completely copied, discarding the journal."""
+        with open(self.marker, 'wb') as fobj:
+            fobj.write(time.strftime('%Y-%m-%d %H:%M:%S\n'))
+            os.fsync(fobj.fileno())
+        if self.fobj is not None:
+            self.fobj.close()
+            self.fobj = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.done = set()
+
+    def _escape(self, relpath):
+        return relpath.replace('\\', '\\\\').replace('\n', '\\n')
+
+    def _unescape(self, line):
+        if '\\' not in line:
+            return line
+        return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n'
+                      else m.group(1), line)
+
+
+class InodeIndex:
+    """Maps source inodes to the destination path first written for them.
+
+    The index is kept in an SQLite database, rather than in memory, since a
+    volume may have tens of millions of entries; it also persists across
+    runs, such that resumed copies can link to what was copied before.
+    Paths are stored relative to the host directory in the target.
+
+    Entries are keyed on the inode alone, since the index is for the one
+    host on a single source volume, whose device number (on Mac OS X, at
+    least) changes each time it is mounted. The device number is recorded
+    as well, only so that an index for another volume can be told apart.
+
+    Files that are still being copied are tracked separately, along with
+    the other paths waiting to be linked to them once the copy completes.
+    The digests of the contents of files can be recorded as well, so that
+    the copies can be verified later without reading the source again.
+    """
+
+    # Number of changes to make between commits.
+    BATCH = 10000
+
+    def __init__(self, path, base):
+        """Initialize an InodeIndex stored at path, for paths under base."""
+        self.base = base
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Paths are byte strings which need not be valid UTF-8.
+        self.db.text_factory = str
+        for table, column in (('inodes', 'path'), ('digests', 'digest')):
+            columns = [row[1] for row in self.db.execute(
+                'PRAGMA table_info(%s)' % table)]
+            if 'dev' in columns:
+                # Written when the device number was part of the key.
+                self.db.execute('ALTER TABLE %s RENAME TO old%s' % (
+                    table, table))
+            self.db.execute('CREATE TABLE IF NOT EXISTS %s ('
+                            'ino INTEGER PRIMARY KEY, %s TEXT)' % (
+                                table, column))
+            if 'dev' in columns:
+                self.db.execute('INSERT OR REPLACE INTO %s SELECT ino, %s '
+                                'FROM old%s' % (table, column, table))
+                self.db.execute('DROP TABLE old%s' % table)
+        self.db.execute('CREATE TABLE IF NOT EXISTS source (dev INTEGER)')
+        self.db.commit()
+        self.lock = threading.RLock()
+        self.inflight = {}
+        self.changes = 0
+
+    def device(self):
+        """Return the device number of the source volume, or None."""
+        with self.lock:
+            row = self.db.execute('SELECT dev FROM source').fetchone()
+        return None if row is None else row[0]
+
+    def setdevice(self, dev):
+        """Record dev as the device number of the source volume."""
+        with self.lock:
+            self.db.execute('DELETE FROM source')
+            self.db.execute('INSERT INTO source VALUES (?)', (dev,))
+            self.db.commit()
+
+    def lookup(self, stats):
+        """Return the destination path written for the inode, or None.
+
+        Paths that no longer exist in the destination are ignored.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT path FROM inodes WHERE ino = ?',
+                                  (stats[stat.ST_INO],)).fetchone()
+        if row is None:
+            return None
+        path = os.path.join(self.base, row[0])
+        return path if os.path.lexists(path) else None
+
+    def add(self, stats, path):
+        """Record that the inode was written to the destination path."""
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO inodes VALUES (?, ?)',
+                            (stats[stat.ST_INO], path[len(self.base) + 1:]))
+            self.changes += 1
+            if self.changes >= self.BATCH:
+                self.commit()
+
+    def setdigest(self, stats, digest):
+        """Record the digest of the contents of the inode."""
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO digests VALUES (?, ?)',
+                            (stats[stat.ST_INO], digest))
+            self.changes += 1
+            if self.changes >= self.BATCH:
+                self.commit()
+
+    def digest(self, stats):
+        """Return the recorded digest of the contents of the inode, or None."""
+        with self.lock:
+            row = self.db.execute('SELECT digest FROM digests WHERE ino = ?',
+                                  (stats[stat.ST_INO],)).fetchone()
+        return None if row is None else row[0]
+
+    def claim(self, stats, waiter):
+        """Claim the inode for copying, returning True if successful.
+
+        If another thread is already copying the inode, waiter is added to
+        the list of paths waiting for that copy, and False is returned.
+        """
+        key = stats[stat.ST_INO]
+        with self.lock:
+            waiters = self.inflight.get(key)
+            if waiters is None:
+                self.inflight[key] = []
+                return True
+            waiters.append(waiter)
+            return False
+
+    def release(self, stats):
+        """Release a claim on the inode, returning the paths waiting on it."""
+        with self.lock:
+            return self.inflight.pop(stats[stat.ST_INO], [])
+
+    def commit(self):
+        """Commit any outstanding changes to the index."""
+        with self.lock:
+            self.db.commit()
+            self.changes = 0
+
+    def close(self):
+        """Commit outstanding changes and close the index."""
+        self.commit()
+        self.db.close()
+
+
+class IndexRestorer(TreeVisitor):
+    """Puts back the index entries lost by an interrupted run.
+
+    The journal records each entry as soon as it is copied, while the
+    index is only committed in batches, so the entries most recently
+    copied may be missing from the index when resuming. Those entries
+    must be put back, or later paths to the same inodes are copied anew
+    rather than linked.
+    """
+
+    def __init__(self, index, src, dst):
+        """Initialize an IndexRestorer for the copy of src at dst."""
+        self.index = index
+        self.src = src
+        self.dst = dst
+
+    def restore(self, path, stats):
+        """Put back the entry for path, and those within it if need be.
+
+        A directory whose own entry survived was committed after all of
+        the entries within it, so those are only restored otherwise.
+        """
+        if stat.S_ISDIR(stats[stat.ST_MODE]):
+            if self.index.lookup(stats) is None:
+                visitfiles(path, self)
+                self.index.add(stats, self.dst + path[len(self.src):])
+        else:
+            self.file(path, stats)
+
+    def dir(self, dir, stats):
+        """Put back the entry for a directory and descend into it."""
+        if self.index.lookup(stats) is None:
+            self.index.add(stats, self.dst + dir[len(self.src):])
+        return True
+
+    def file(self, file, stats):
+        """Put back the entry for a file with other links."""
+        if stats[stat.ST_NLINK] > 1 and self.index.lookup(stats) is None:
+            self.index.add(stats, self.dst + file[len(self.src):])
+
+    link = file
+
+
+class DedupCache:
+    """Finds copied files whose contents are identical to a new file.
+
+    Time Machine sometimes stores identical files as different inodes,
+    such as when only the metadata changed. Previously copied files are
+    remembered by size and modification time; those that also match in
+    permissions, ownership, and extended attributes (all of which hard
+    links must share) are then compared by a digest of their contents.
+    Digests and attributes are computed only when needed, and the least
+    recently used sizes and times are evicted once the cache is full.
+    """
+
+    # Maximum number of size and modification time keys to remember.
+    MAXKEYS = 100000
+
+    # Maximum number of files remembered for each key.
+    MAXFILES = 4
+
+    def __init__(self, maxkeys=MAXKEYS):
+        """Initialize a DedupCache holding up to maxkeys keys."""
+        self.maxkeys = maxkeys
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.linked = 0
+        self.saved = 0
+
+    def find(self, file, stats):
+        """Return the destination of a copy identical to file, or None."""
+        key = (stats[stat.ST_SIZE], stats[stat.ST_MTIME])
+        with self.lock:
+            candidates = self.cache.pop(key, None)
+            if candidates is None:
+                return None
+            self.cache[key] = candidates
+            candidates = list(candidates)
+        meta = (stats[stat.ST_MODE], stats[stat.ST_UID], stats[stat.ST_GID])
+        attrs = None
+        digest = None
+        for candidate in candidates:
+            # Each is a list of source, destination, metadata, extended
+            # attributes, and digest, with the last two filled in lazily.
+            if candidate[2] != meta:
+                continue
+            if attrs is None:
+                attrs = readxattrs(file)
+            if candidate[3] is None:
+                candidate[3] = readxattrs(candidate[0])
+            if candidate[3] != attrs:
+                continue
+            if digest is None:
+                digest = filedigest(file)
+            if candidate[4] is None:
+                candidate[4] = filedigest(candidate[0])
+            if candidate[4] == digest and os.path.exists(candidate[1]):
+                with self.lock:
+                    self.linked += 1
+                    self.saved += stats[stat.ST_SIZE]
+                return candidate[1]
+        return None
+
+    def add(self, file, dst, stats):
+        """Remember that file was copied to dst."""
+        if not stats[stat.ST_SIZE]:
+            # Linking empty files saves nothing but inodes.
+            return
+        key = (stats[stat.ST_SIZE], stats[stat.ST_MTIME])
+        meta = (stats[stat.ST_MODE], stats[stat.ST_UID], stats[stat.ST_GID])
+        with self.lock:
+            candidates = self.cache.pop(key, [])
+            candidates.append([file, dst, meta, None, None])
+            self.cache[key] = candidates[-self.MAXFILES:]
+            while len(self.cache) > self.maxkeys:
+                self.cache.popitem(last=False)
+
+    def report(self):
+        """Print the number of files and bytes saved by deduplication."""
+        print "Linked %d identical files (%d bytes saved)" % (
+            self.linked, self.saved)
+
+
+class ManifestVisitor(TreeVisitor):
+    """Lists the entries of a tree, for a LinkFarm."""
+
+    def __init__(self, root, manifest):
+        """Initialize a ManifestVisitor adding the entries to manifest."""
+        self.root = root
+        self.manifest = manifest
+
+    def dir(self, dir, stats):
+        """Add a directory, along with its stats and extended attributes."""
+        self.manifest.append((dir[len(self.root):], stats, readxattrs(dir)))
+        return True
+
+    def file(self, file, stats):
+        """Add a file."""
+        self.manifest.append((file[len(self.root):], None, None))
+
+    def link(self, link, stats):
+        """Add a symbolic link."""
+        self.manifest.append((link[len(self.root):], None, None))
+
+
+class LinkFarm:
+    """Recreates directories on targets that cannot hard link them.
+
+    Time Machine hard links the directories that have not changed since
+    the previous snapshot, which most file systems other than HFS+ do not
+    allow. Instead, such a directory is created anew, with every entry
+    within it (at any depth) hard linked to the same entry in the copy of
+    the previous snapshot, such that the source is not read at all.
+
+    The entries in each directory so recreated are remembered as a
+    manifest, by the inode of the source directory, so that when it is
+    unchanged in the next snapshot as well, the previous copy need not be
+    read again. Manifests are only kept for the snapshot just copied, and
+    only up to a number of entries in all.
+    """
+
+    # Maximum number of entries in the manifests kept for a snapshot.
+    MAXENTRIES = 1000000
+
+    def __init__(self, enabled=False):
+        """Initialize a LinkFarm, used for all directories if enabled."""
+        self.enabled = enabled
+        self.manifests = {}
+        self.upcoming = {}
+        self.entries = 0
+
+    def rotate(self):
+        """Use the manifests from the snapshot just copied for the next."""
+        self.manifests = self.upcoming
+        self.upcoming = {}
+        self.entries = 0
+
+    def manifest(self, stats, old):
+        """Return the manifest of the copy at old of the source directory.
+
+        Each entry is a (relpath, stats, attrs) tuple, where relpath is
+        relative to old, and stats and attrs (the extended attributes) are
+        None for anything but directories. The directory itself is first.
+        """
+        key = (stats[stat.ST_DEV], stats[stat.ST_INO])
+        manifest = self.manifests.get(key)
+        if manifest is None:
+            manifest = [('', os.lstat(old), readxattrs(old))]
+            visitfiles(old, ManifestVisitor(old, manifest))
+        if self.entries + len(manifest) <= self.MAXENTRIES:
+            self.upcoming[key] = manifest
+            self.entries += len(manifest)
+        return manifest
+
+    def expand(self, stats, old, dst):
+        """Recreate the copy at old of the source directory at dst.
+
+        Anything left at dst by an interrupted run is reused or replaced.
+        """
+        dirs = []
+        for relpath, dstats, attrs in self.manifest(stats, old):
+            target = dst + relpath
+            if dstats is None:
+                try:
+                    link(old + relpath, target)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise e
+                    os.unlink(target)
+                    link(old + relpath, target)
+                runstats.count('linked')
+                continue
+            if not os.path.isdir(target):
+                opthrottle.wait()
+                os.mkdir(target)
+            chown(target, dstats[stat.ST_UID], dstats[stat.ST_GID])
+            if attrs:
+                opthrottle.wait()
+                dx = xattr.xattr(target)
+                try:
+                    for name, value in attrs:
+                        dx.set(name, value, xattr.constants.XATTR_NOFOLLOW)
+                except IOError:
+                    print "WARNING: cannot xattr %s" % target
+            runstats.count('dirs')
+            dirs.append((target, dstats))
+        # Deepest first, as creating the entries changed the times.
+        for target, dstats in reversed(dirs):
+            copystat(dstats, target)
+
+
+def lstatold(old):
+    """Return the result of lstat() on old, or None if it does not exist.
+
+    The entry at old not existing, or not being a directory when one of
+    its parents was expected to be, is not an error.
+    """
+    try:
+        return os.lstat(old)
+    except OSError, e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EISDIR):
+            # File became directory, or vice versa, or just isn't there.
+            return None
+        raise e
+
+
+def sameinode(old, stats):
+    """Return True if the entry at old has the same inode as stats."""
+    ostats = lstatold(old)
+    return ostats is not None and stats[stat.ST_INO] == ostats[stat.ST_INO]
+
+
+def iter_changes(prev, curr):
+    """Yield the entries of snapshot curr that differ from snapshot prev.
+
+    Each is yielded as a (relpath, stats, ostats) tuple, where relpath is
+    the path of the entry relative to curr (starting with a slash), stats
+    the result of lstat() on it, and ostats that of the entry at the same
+    path in prev, or None if there is no such entry (or prev is None, when
+    curr is the first snapshot). Directories with the same inode in both
+    snapshots are not descended into, and nor are the entries that the
+    path rules leave out yielded (or, for directories, descended into).
+
+    Entries are yielded depth first, sorted by name within a directory,
+    with each directory before its contents. Only the entries yet to be
+    visited in the directories along the current path are held in memory.
+    """
+    stack = [(curr, None)]
+    while stack:
+        path, stats = stack.pop()
+        if stats is not None:
+            relpath = path[len(curr):]
+            if pathrules.active and pathrules.excluded(
+                    relpath, stat.S_ISDIR(stats[stat.ST_MODE])):
+                continue
+            try:
+                ostats = None if prev is None else lstatold(prev + relpath)
+            except OSError, e:
+                error(e, prev + relpath)
+                continue
+            if ostats is not None and \
+                    ostats[stat.ST_INO] == stats[stat.ST_INO]:
+                continue
+            yield relpath, stats, ostats
+            if not stat.S_ISDIR(stats[stat.ST_MODE]):
+                continue
+        try:
+            entries = listentries(path)
+        except OSError, e:
+            error(e, path)
+            continue
+        # Sort in reverse so that they are popped off in order.
+        entries.sort(reverse=True)
+        stack.extend(entries)
+
+
+def changerows(changes, depth=None, nosymlinks=False, totals=None):
+    """Yield (old size, new size, name, count) rows for the changes.
+
+    changes are as yielded by iter_changes(). Names of directories end with
+    a slash, and those of symbolic links with an at sign. If depth is given,
+    the changes deeper than that (and directories at that depth) are summed
+    up in a single row for their directory at depth, with count being the
+    number of entries within it; otherwise count is None, as is the old size
+    of a new entry. If nosymlinks is True, symbolic links are left out.
+    If totals is given, the number and size of the changes are added to it.
+    """
+    group = None
+    for relpath, stats, ostats in changes:
+        size = stats[stat.ST_SIZE]
+        osize = None if ostats is None else ostats[stat.ST_SIZE]
+        mode = stats[stat.ST_MODE]
+        if totals is not None:
+            totals[1] += size
+        if nosymlinks and stat.S_ISLNK(mode):
+            continue
+        if totals is not None:
+            totals[0] += 1
+        if depth is not None:
+            level = relpath.count('/')
+            if level > depth or (stat.S_ISDIR(mode) and level == depth):
+                name = '/'.join(relpath.split('/')[:depth + 1]) + '/'
+                if group is not None and group[2] != name:
+                    if group[0] or group[1]:
+                        yield tuple(group)
+                    group = None
+                if group is None:
+                    group = [None, 0, name, -1]
+                if osize is not None:
+                    group[0] = (group[0] or 0) + osize
+                group[1] += size
+                group[3] += 1
+                continue
+        if group is not None:
+            if group[0] or group[1]:
+                yield tuple(group)
+            group = None
+        if stat.S_ISDIR(mode):
+            relpath += '/'
+        elif stat.S_ISLNK(mode):
+            relpath += '@'
+        yield osize, size, relpath, None
+    if group is not None and (group[0] or group[1]):
+        yield tuple(group)
+
+
+def formatsize(size, base=1024):
+    """Return size in bytes as a short, human readable string."""
+    if size is None:
+        return '...'
+    suffix = ''
+    for unit in ('K', 'M', 'G', 'T', 'P'):
+        if size < base:
+            break
+        size = size / float(base)
+        suffix = unit + ('i' if base == 1024 else '')
+    if not suffix:
+        return '%dB' % size
+    return '%.1f%sB' % (size, suffix)
+
+
+def reportchanges(prev, curr, depth=None, minsize=0, sort='name', top=0,
+                  nosymlinks=False, changes=None):
+    """Print the entries of snapshot curr that differ from snapshot prev.
+
+    This is the report of the timedog script: depth, if given, summarizes
+    the changes below that depth, and rows whose new size is less than
+    minsize are left out. The rows are sorted by 'old' size, 'new' size,
+    or 'name'; sorting by size means holding all of the rows in memory,
+    unless top is given, in which case only the top largest are kept.
+    If changes is given, as by Catalog.changes(), the snapshots are not
+    compared at all.
+    """
+    if changes is None:
+        changes = iter_changes(prev, curr)
+    totals = [0, 0]
+    rows = changerows(changes, depth, nosymlinks, totals)
+    if minsize:
+        rows = (row for row in rows if row[1] >= minsize)
+    if sort == 'name':
+        key = lambda row: row[2]
+    else:
+        column = 0 if sort == 'old' else 1
+        key = lambda row: (-1 if row[column] is None else row[column], row[2])
+    if top:
+        # Sizes rank the rows, even when sorting them by name.
+        rank = key if sort != 'name' else lambda row: (row[1], row[2])
+        rows = sorted(heapq.nlargest(top, rows, key=rank), key=key)
+    elif sort != 'name':
+        rows = sorted(rows, key=key)
+    print "==> Comparing backup %s to %s" % (
+        os.path.basename(curr.rstrip('/')), os.path.basename(prev.rstrip('/')))
+    header = "%11s -> %11s" % ("Old Size", "New Size")
+    rule = "=" * 11 + " -> " + "=" * 11
+    if depth is not None:
+        header += " %9s" % "# in Dir"
+        rule += " " + "=" * 9
+    print header + " File/Directory"
+    print rule + " " + "=" * 20
+    for osize, size, name, count in rows:
+        line = "%11s -> %11s" % (formatsize(osize), formatsize(size))
+        if depth is not None:
+            line += " %9s" % ("[%d]" % count if count else "")
+        print line + " " + name
+    print "==> Total Backup: %d changed files/directories, %s" % (
+        totals[0], formatsize(totals[1]))
+
+
+class Catalog:
+    """A compact record of how a snapshot differs from the one before it.
+
+    The catalog holds the entries that iter_changes() yields for the
+    snapshot, so that a report of the changes need not walk the volume at
+    all. Each entry is a fixed size record (the path being kept in a heap
+    of strings after the records). The entries of each directory are
+    consecutive and sorted by name, and the record of a directory points
+    to those of its entries, so the file can be searched for a path, in
+    place, without reading all of it.
+    """
+
+    MAGIC = 'TMCATLG2'
+    # Number of records, the first and number of records in the root,
+    # and the length of the name of the previous snapshot.
+    HEADER = struct.Struct('>8sIIIH')
+    # Path offset and length, mode, inode, size, old size, mtime, action,
+    # and for directories, the first and number of records within.
+    RECORD = struct.Struct('>QIIQqqdcII')
+    # The entry was not in the previous snapshot, or was replaced.
+    ADDED = 'A'
+    REPLACED = 'R'
+
+    def __init__(self, path):
+        """Open the catalog at path."""
+        self.path = path
+        self.name = os.path.basename(path)[:-len('.catalog')]
+        with open(path, 'rb') as fobj:
+            self.data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, start, count, length = \
+            self.HEADER.unpack_from(self.data)
+        if magic != self.MAGIC:
+            raise IOError(errno.EINVAL, "%s is not a catalog" % path)
+        self.root = (start, count)
+        start = self.HEADER.size
+        self.prev = self.data[start:start + length] or None
+        self.records = start + length
+        self.heap = self.records + self.count * self.RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def relpath(self, i):
+        """Return the path of the i-th entry."""
+        offset, length = struct.unpack_from(
+            '>QI', self.data, self.records + i * self.RECORD.size)
+        return self.data[self.heap + offset:self.heap + offset + length]
+
+    def children(self, i):
+        """Return the first and number of entries in the i-th entry."""
+        return struct.unpack_from(
+            '>II', self.data,
+            self.records + (i + 1) * self.RECORD.size - 8)
+
+    def entry(self, i):
+        """Return the i-th entry as a (relpath, stats, ostats) tuple.
+
+        The stats hold only the mode, inode, size and modification time,
+        and ostats (None for an added entry) only the size.
+        """
+        offset, length, mode, ino, size, osize, mtime, action, start, \
+            count = self.RECORD.unpack_from(
+                self.data, self.records + i * self.RECORD.size)
+        relpath = self.data[self.heap + offset:self.heap + offset + length]
+        stats = os.stat_result((mode, ino, 0, 1, 0, 0, size, 0, mtime, 0))
+        ostats = None
+        if action == self.REPLACED:
+            ostats = os.stat_result((0, 0, 0, 1, 0, 0, osize, 0, 0, 0))
+        return relpath, stats, ostats
+
+    def changes(self):
+        """Yield all of the entries, in the order iter_changes() would."""
+        start, count = self.root
+        stack = range(start + count - 1, start - 1, -1)
+        while stack:
+            i = stack.pop()
+            yield self.entry(i)
+            start, count = self.children(i)
+            stack.extend(xrange(start + count - 1, start - 1, -1))
+
+    def find(self, relpath):
+        """Return the entry for relpath, or None if it did not change."""
+        start, count = self.root
+        prefix = ''
+        for part in relpath.strip('/').split('/'):
+            prefix += '/' + part
+            # The paths in a directory differ only in their last part.
+            lo, hi = start, start + count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.relpath(mid) < prefix:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo == start + count or self.relpath(lo) != prefix:
+                return None
+            start, count = self.children(lo)
+        return self.entry(lo)
+
+    def close(self):
+        """Close the catalog."""
+        self.data.close()
+
+
+class CatalogWriter:
+    """Writes a Catalog as the changes in a snapshot are found.
+
+    The entries must be added a directory at a time, as visitfiles()
+    visits them, with the entries of each directory added together (in
+    any order) before those within its subdirectories. Only the entries
+    of the current directory, and the directories yet to be listed, are
+    held in memory; the records and paths are written to temporary files
+    that are put together when the catalog is closed.
+    """
+
+    def __init__(self, path, prev):
+        """Initialize a CatalogWriter for a catalog at path.
+
+        prev is the name of the previous snapshot, if any.
+        """
+        self.path = path
+        self.prev = prev or ''
+        self.records = open(path + '.records', 'w+b')
+        self.heap = open(path + '.heap', 'wb')
+        self.offset = 0
+        self.count = 0
+        self.root = (0, 0)
+        self.parent = None
+        self.entries = []
+        # The records of the directories whose entries are still to come.
+        self.pending = {}
+
+    def add(self, relpath, stats, ostats):
+        """Add the entry at relpath, with ostats for the previous one."""
+        parent = relpath[:relpath.rindex('/')]
+        if parent != self.parent:
+            self.flush()
+            self.parent = parent
+        self.entries.append((relpath, stats, ostats))
+
+    def enddir(self, relpath):
+        """Note that all of the entries in the directory have been added."""
+        if relpath == self.parent:
+            self.flush()
+        self.pending.pop(relpath, None)
+
+    def flush(self):
+        """Write out the entries of the current directory."""
+        if not self.entries:
+            return
+        self.entries.sort(key=lambda entry: entry[0])
+        start = self.count
+        for relpath, stats, ostats in self.entries:
+            if stat.S_ISDIR(stats[stat.ST_MODE]):
+                self.pending[relpath] = self.count
+            self.records.write(Catalog.RECORD.pack(
+                self.offset, len(relpath), stats[stat.ST_MODE],
+                stats[stat.ST_INO], stats[stat.ST_SIZE],
+                -1 if ostats is None else ostats[stat.ST_SIZE],
+                stats.st_mtime,
+                Catalog.ADDED if ostats is None else Catalog.REPLACED, 0, 0))
+            self.heap.write(relpath)
+            self.offset += len(relpath)
+            self.count += 1
+        if self.parent == '':
+            self.root = (start, len(self.entries))
+        else:
+            index = self.pending.pop(self.parent, None)
+            if index is not None:
+                # Point the record of the directory to its entries.
+                self.records.seek((index + 1) * Catalog.RECORD.size - 8)
+                self.records.write(struct.pack('>II', start,
+                                               len(self.entries)))
+                self.records.seek(0, os.SEEK_END)
+        self.entries = []
+
+    def close(self):
+        """Write the catalog, replacing any there was already."""
+        self.flush()
+        self.heap.close()
+        self.records.seek(0)
+        with open(self.path + '.tmp', 'wb') as fobj:
+            fobj.write(Catalog.HEADER.pack(Catalog.MAGIC, self.count,
+                                           self.root[0], self.root[1],
+                                           len(self.prev)))
+            fobj.write(self.prev)
+            shutil.copyfileobj(self.records, fobj)
+            with open(self.path + '.heap', 'rb') as heap:
+                shutil.copyfileobj(heap, fobj)
+        self.records.close()
+        os.unlink(self.path + '.records')
+        os.unlink(self.path + '.heap')
+        os.rename(self.path + '.tmp', self.path)
+
+
+class CatalogScanner(TreeVisitor):
+    """Adds the entries of a snapshot that changed to a CatalogWriter.
+
+    Directories that did not change are not descended into, and nor are
+    those left out by the path rules.
+    """
+
+    def __init__(self, writer, old, src):
+        """Initialize a CatalogScanner for snapshot src.
+
+        old is the previous snapshot, or None if there is none.
+        """
+        self.writer = writer
+        self.old = old
+        self.src = src
+
+    def scan(self, dir):
+        """Add the changed entries within dir (but not dir itself)."""
+        visitfiles(dir, self)
+        self.writer.enddir(dir[len(self.src):])
+
+    def add(self, path, stats):
+        """Add the entry at path, returning True if it changed."""
+        relpath = path[len(self.src):]
+        if pathrules.active and pathrules.excluded(
+                relpath, stat.S_ISDIR(stats[stat.ST_MODE])):
+            return False
+        ostats = None if self.old is None else lstatold(self.old + relpath)
+        if ostats is not None and ostats[stat.ST_INO] == stats[stat.ST_INO]:
+            return False
+        self.writer.add(relpath, stats, ostats)
+        return True
+
+    def dir(self, dir, stats):
+        """Add a directory, descending only if it changed."""
+        return self.add(dir, stats)
+
+    def enddir(self, dir, stats):
+        """Note that the entries within dir have been added."""
+        self.writer.enddir(dir[len(self.src):])
+
+    def file(self, file, stats):
+        """Add a file."""
+        self.add(file, stats)
+
+    def link(self, link, stats):
+        """Add a symbolic link."""
+        self.add(link, stats)
+
+
+def catalogsnapshot(prev, curr, path):
+    """Write the catalog of snapshot curr, compared to prev, to path.
+
+    prev is None for the first snapshot, all of whose entries are added.
+    """
+    writer = CatalogWriter(path, prev and os.path.basename(prev))
+    CatalogScanner(writer, prev, curr).scan(curr)
+    writer.close()
+
+
+def listcatalogs(catdir):
+    """Return the Catalogs in catdir, sorted by snapshot name."""
+    names = sorted(name for name in os.listdir(catdir)
+                   if name.endswith('.catalog'))
+    return [Catalog(os.path.join(catdir, name)) for name in names]
+
+
+def indexbackupdb(srcbase, catdir):
+    """Write the catalogs of every snapshot in srcbase to catdir.
+
+    The catalogs of each host are written to a directory of that name
+    in catdir; those already written are left as they are.
+    """
+    srcdb = os.path.join(srcbase, 'Backups.backupdb')
+    if not os.path.exists(srcdb):
+        print "ERROR: %s does not contain a Time Machine backup!" % srcbase
+        sys.exit(2)
+    for host in listhosts(srcdb):
+        src = os.path.join(srcdb, host)
+        hostdir = os.path.join(catdir, host)
+        if not os.path.isdir(hostdir):
+            os.makedirs(hostdir)
+        prev = None
+        for entry in listsnapshots(src):
+            path = os.path.join(hostdir, entry + '.catalog')
+            if not os.path.exists(path):
+                print "Cataloging backup %s..." % entry
+                catalogsnapshot(prev, os.path.join(src, entry), path)
+            prev = os.path.join(src, entry)
+
+
+def reporthistory(catdir, relpath):
+    """Print the snapshots in which the entry at relpath changed.
+
+    relpath is relative to the snapshots (e.g. /Macintosh HD/etc/hosts)
+    and catdir is the directory of catalogs for a single host. The first
+    snapshot listed is where the entry first appeared.
+    """
+    relpath = '/' + relpath.strip('/')
+    found = False
+    for catalog in listcatalogs(catdir):
+        entry = catalog.find(relpath)
+        if entry is not None:
+            stats, ostats = entry[1], entry[2]
+            print "%s %-8s %11s %s" % (
+                catalog.name, 'added' if ostats is None else 'replaced',
+                formatsize(stats[stat.ST_SIZE]),
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.localtime(stats.st_mtime)))
+            found = True
+        catalog.close()
+    if not found:
+        print "%s not found in %s" % (relpath, catdir)
+
+
+class ChangeScanner(TreeVisitor):
+    """Records how a snapshot differs from the one before it.
+
+    The snapshot is traversed as a CopyBackupVisitor would, comparing the
+    inodes with those in the previous snapshot and not descending into
+    unchanged directories. Each step of the traversal is pickled to a file,
+    to be replayed into a CopyBackupVisitor later by replaychanges(), such
+    that snapshots can be compared ahead of (and in parallel with) copying.
+    """
+
+    def __init__(self, old, fobj):
+        """Initialize a ChangeScanner to compare with the old snapshot.
+
+        The records are written to the file object fobj.
+        """
+        self.old = old
+        self.pickler = cPickle.Pickler(fobj, 2)
+
+    def scan(self, src):
+        """Record the differences between src and the old snapshot."""
+        self.src = src
+        visitfiles(src, self, pathrules)
+
+    def emit(self, kind, path, stats, ostats):
+        """Write a single record to the file.
+
+        ostats is the result of lstat() on the entry in the old snapshot,
+        or None if there is no such entry.
+        """
+        if stats is not None and not isinstance(stats, os.stat_result):
+            # The stat results of the scandir module cannot be pickled.
+            extra = dict((name, getattr(stats, name)) for name in (
+                'st_atime', 'st_mtime', 'st_ctime', 'st_blksize',
+                'st_blocks', 'st_rdev', 'st_flags', 'st_gen',
+                'st_birthtime') if hasattr(stats, name))
+            stats = os.stat_result(tuple(stats), extra)
+        self.pickler.dump((kind, path[len(self.src):], stats, ostats))
+        # Keep the pickler from holding on to everything written.
+        self.pickler.clear_memo()
+
+    def startdir(self, dir):
+        """Record that the contents of dir follow."""
+        self.emit('b', dir, None, None)
+
+    def dir(self, dir, stats):
+        """Record a directory, descending only if it has changed."""
+        ostats = lstatold(self.old + dir[len(self.src):])
+        self.emit('d', dir, stats, ostats)
+        return ostats is None or ostats[stat.ST_INO] != stats[stat.ST_INO]
+
+    def enddir(self, dir, stats):
+        """Record that the contents of dir have all been recorded."""
+        self.emit('e', dir, stats, None)
+
+    def file(self, file, stats):
+        """Record a file."""
+        self.emit('f', file, stats,
+                  lstatold(self.old + file[len(self.src):]))
+
+    def link(self, link, stats):
+        """Record a symbolic link."""
+        self.emit('l', link, stats,
+                  lstatold(self.old + link[len(self.src):]))
+
+
+def scanchanges(old, src, path):
+    """Write the differences between snapshot src and old to path.
+
+    This is run in the scanner processes; returns path when done.
+    """
+    with open(path, 'wb') as fobj:
+        ChangeScanner(old, fobj).scan(src)
+    return path
+
+
+def replaychanges(path, src, visitor):
+    """Replay the differences recorded by a ChangeScanner into visitor.
+
+    This has the same effect as visitfiles(src, visitor) for the
+    CopyBackupVisitor, without comparing the inodes of the two snapshots
+    again. Directories the visitor declines to descend into are skipped.
+    """
+    declined = set()
+    depth = 0
+    with open(path, 'rb') as fobj:
+        unpickler = cPickle.Unpickler(fobj)
+        while True:
+            try:
+                kind, relpath, stats, ostats = unpickler.load()
+            except EOFError:
+                break
+            same = ostats is not None and \
+                ostats[stat.ST_INO] == stats[stat.ST_INO]
+            pathname = src + relpath
+            if depth:
+                # Skipping the contents of a declined directory.
+                if kind == 'b':
+                    depth += 1
+                elif kind == 'e':
+                    depth -= 1
+                continue
+            if kind == 'b':
+                if pathname in declined:
+                    declined.remove(pathname)
+                    depth = 1
+                continue
+            visitor.known = same
+            visitor.ostats = ostats
+            try:
+                if kind == 'd':
+                    if not visitor.dir(pathname, stats) and not same:
+                        declined.add(pathname)
+                elif kind == 'e':
+                    visitor.enddir(pathname, stats)
+                elif kind == 'f':
+                    visitor.file(pathname, stats)
+                elif kind == 'l':
+                    visitor.link(pathname, stats)
+            except OSError, e:
+                error(e, pathname)
+    visitor.known = None
+    visitor.ostats = None
+
+
+class Planner(TreeVisitor):
+    """Works out what copying snapshots entails, without copying them.
+
+    Each snapshot is traversed as it would be when copying, comparing the
+    inodes with those in the previous snapshot and not descending into the
+    unchanged directories, but nothing is read or written; only the stats
+    already collected by the traversal are used. Entries with an inode seen
+    earlier count as hard links, as the InodeIndex will link them as well.
+    """
+
+    def __init__(self):
+        """Initialize a Planner."""
+        self.seen = set()
+
+    def plan(self, old, src):
+        """Return the totals for copying snapshot src as a dictionary.
+
+        old is the previous snapshot, or None if src is the first. The
+        totals are the bytes to be copied (and blocks allocated to them),
+        and the number of files, links, symlinks and dirs to be created.
+        """
+        self.old = old
+        self.src = src
+        self.totals = dict.fromkeys(('bytes', 'blocks', 'files', 'links',
+                                     'symlinks', 'dirs'), 0)
+        visitfiles(src, self, pathrules)
+        return self.totals
+
+    def linked(self, path, stats):
+        """Return True if path would be linked to an existing entry."""
+        if self.old is not None and \
+                sameinode(self.old + path[len(self.src):], stats):
+            return True
+        key = (stats[stat.ST_DEV], stats[stat.ST_INO])
+        if key in self.seen:
+            return True
+        if stat.S_ISDIR(stats[stat.ST_MODE]) or stats[stat.ST_NLINK] > 1:
+            self.seen.add(key)
+        return False
+
+    def allocated(self, stats):
+        """Return the number of bytes the copy of the entry will take up.
+
+        This is the size rounded up to a whole number of blocks, unless
+        the entry is a sparse file, which take up as much as in the source.
+        """
+        blksize = getattr(stats, 'st_blksize', None) or 4096
+        size = -(-stats[stat.ST_SIZE] // blksize) * blksize
+        blocks = getattr(stats, 'st_blocks', None)
+        if blocks is not None:
+            return min(size, blocks * 512)
+        return size
+
+    def dir(self, dir, stats):
+        """Count a directory, descending only if it has changed."""
+        if self.linked(dir, stats):
+            self.totals['links'] += 1
+            return False
+        self.totals['dirs'] += 1
+        self.totals['blocks'] += self.allocated(stats)
+        return True
+
+    def file(self, file, stats):
+        """Count a file."""
+        if self.linked(file, stats):
+            self.totals['links'] += 1
+        else:
+            self.totals['files'] += 1
+            self.totals['bytes'] += stats[stat.ST_SIZE]
+            self.totals['blocks'] += self.allocated(stats)
+
+    def link(self, link, stats):
+        """Count a symbolic link."""
+        if self.linked(link, stats):
+            self.totals['links'] += 1
+        else:
+            self.totals['symlinks'] += 1
+
+
+def plansnapshots(src, dst, statedir, planner, snapfilter=None):
+    """Yield the snapshot name and plan for each snapshot to be copied.
+
+    src and dst are the host directories in the source and target, and
+    statedir is where the progress of the copy is kept. snapfilter, if
+    given, selects the snapshots to be copied.
+    """
+    prev = None
+    for entry in listsnapshots(src, snapfilter, dst):
+        journal = Journal(statedir, entry)
+        if not journal.iscomplete() and (journal.resuming or not
+                                         os.path.exists(os.path.join(dst,
+                                                                     entry))):
+            old = None if prev is None else os.path.join(src, prev)
+            yield entry, planner.plan(old, os.path.join(src, entry))
+        prev = entry
+
+
+class Progress:
+    """Periodically prints how much of the planned copy has been done.
+
+    The fraction done is estimated from the bytes copied and the entries
+    created so far, as counted by runstats, with each entry weighed as if
+    it were some number of bytes, to account for the time spent on the
+    metadata; the time remaining is extrapolated from the time taken.
+    """
+
+    def __init__(self, totals, interval=30):
+        """Initialize a Progress for the given planned totals."""
+        self.total = totals['bytes'] + ENTRY_BYTES * (
+            totals['files'] + totals['links'] + totals['symlinks'] +
+            totals['dirs'])
+        self.interval = interval
+        self.started = time.time()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._reporter)
+        self.thread.daemon = True
+
+    def start(self):
+        """Start printing the progress periodically."""
+        self.thread.start()
+
+    def stop(self):
+        """Stop printing the progress."""
+        self.stopped.set()
+        self.thread.join()
+
+    def done(self):
+        """Return the fraction of the planned work that has been done."""
+        done = workdone(runstats.totals())
+        if not self.total:
+            return 1.0
+        return min(float(done) / self.total, 1.0)
+
+    def report(self):
+        """Print the progress made and the estimated time remaining."""
+        fraction = self.done()
+        if fraction:
+            remaining = int((time.time() - self.started) *
+                            (1 - fraction) / fraction)
+            print "%.1f%% done, about %d:%02d:%02d remaining" % (
+                fraction * 100, remaining / 3600, remaining / 60 % 60,
+                remaining % 60)
+        else:
+            print "0.0% done"
+
+    def _reporter(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+
+class CopyInitialVisitor(TreeVisitor):
+    """Copies a directory tree from one place to another."""
+
+    def __init__(self, verbose, dryrun, extattr, pool=None, journal=None,
+                 index=None, dedup=None, checksum=False, farm=None,
+                 catalog=None):
+        """Initialize a CopyInitialVisitor.
+
+        If verbose is True, display operations as they are performed
+        If dryrun is True, do not make any modifications on disk.
+        If extattr is True, just copy the extended attributes.
+        pool is the CopyPool used to copy files (default copies inline).
+        journal is the Journal in which to record progress, if any.
+        index is the InodeIndex used to find entries to link to, if any.
+        dedup is the DedupCache used to find identical files, if any.
+        If checksum is True, record the digests of the files in the index.
+        farm is the LinkFarm used when directories cannot be linked, if any.
+        catalog is the CatalogWriter to add the entries copied to, if any.
+        """
+        self.verbose = verbose
+        self.dryrun = dryrun
+        self.extattr = extattr
+        self.pool = pool or CopyPool()
+        self.journal = journal
+        self.index = index
+        self.dedup = dedup
+        self.checksum = checksum and index is not None
+        self.farm = farm
+        self.catalog = catalog
+        # The previous snapshot, and the entry there for that being copied.
+        self.old = None
+        self.ostats = None
+
+    def copytree(self, src, dst, changes=None):
+        """Copy the directory tree rooted at src to dst.
+
+        If changes is given, it is the path of the differences recorded
+        by a ChangeScanner, which are used instead of traversing src.
+        Returns once all of the file copies have completed.
+        """
+        self.src = src
+        self.dst = dst
+        # The number of errors when each directory still open was created.
+        self.opened = {src: errorcount()}
+        # Directories linked from the index, yet to be cataloged.
+        self.linked = []
+        if changes is None:
+            visitfiles(src, self, pathrules)
+        else:
+            replaychanges(changes, src, self)
+        for dir in self.linked:
+            CatalogScanner(self.catalog, self.old, src).scan(dir)
+        self.pool.flush()
+        self.enddir(src, os.lstat(src))
+        self.pool.join()
+
+    def target(self, path):
+        """Return the destination path for the given source path."""
+        return self.dst + path[len(self.src):]
+
+    def record(self, path):
+        """Record in the journal that path has been copied."""
+        if self.journal is not None:
+            self.journal.record(path[len(self.src) + 1:])
+
+    def hardlink(self, src, path):
+        """Hard link the destination for path to the existing entry src."""
+        dst = self.target(path)
+        if self.verbose:
+            print "ln <%s> <%s>" % (dst, src)
+        if not self.dryrun:
+            # Create hard link in destination.
+            link(src, dst)
+            self.record(path)
+            runstats.count('linked')
 
+    def linkdir(self, old, dir, stats):
+        """Link the destination for directory dir to its existing copy old.
 
-class CopyInitialVisitor(TreeVisitor):
-    """Copies a directory tree from one place to another."""
+        If the target does not allow hard links to directories, the farm
+        (if any) is used to recreate the directory instead, both now and
+        from then on. When resuming, a directory left partly recreated by
+        the interrupted run means the farm was in use, and it is finished.
+        """
+        if self.journal is not None and self.journal.resuming and \
+                (self.farm is None or not self.farm.enabled):
+            try:
+                dstats = os.lstat(self.target(dir))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise e
+                dstats = None
+            if dstats is not None and stat.S_ISDIR(dstats[stat.ST_MODE]):
+                if dstats[stat.ST_INO] == os.lstat(old)[stat.ST_INO]:
+                    # Linked already, but not yet recorded as such.
+                    self.record(dir)
+                    return
+                if self.farm is not None:
+                    print "Resuming directories recreated on target, " \
+                        "linking their contents instead"
+                    self.farm.enabled = True
+        if self.farm is None or not self.farm.enabled:
+            try:
+                self.hardlink(old, dir)
+                return
+            except OSError, e:
+                if self.farm is None or e.errno != errno.EPERM:
+                    raise e
+                print "Cannot link directories on target, " \
+                    "linking their contents instead"
+                self.farm.enabled = True
+        dst = self.target(dir)
+        if self.verbose:
+            print "expand <%s> <%s>" % (dst, old)
+        if not self.dryrun:
+            self.farm.expand(stats, old, dst)
+            self.record(dir)
 
-    def __init__(self, verbose, dryrun, extattr):
-        """Initialize a CopyInitialVisitor.
+    def resume(self, path, stats):
+        """Return True if path was copied by an earlier, interrupted run.
 
-        If verbose is True, display operations as they are performed
-        If dryrun is True, do not make any modifications on disk.
-        If extattr is True, just copy the extended attributes.
+        Otherwise anything left partially copied at the destination is
+        removed, except for directories, which are reused.
         """
-        self.verbose = verbose
-        self.dryrun = dryrun
-        self.extattr = extattr
+        if self.journal is None or not self.journal.resuming:
+            return False
+        if self.journal.isdone(path[len(self.src) + 1:]):
+            if self.index is not None:
+                IndexRestorer(self.index, self.src, self.dst).restore(
+                    path, stats)
+            return True
+        dst = self.target(path)
+        try:
+            if not stat.S_ISDIR(os.lstat(dst)[stat.ST_MODE]):
+                os.unlink(dst)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise e
+        return False
 
-    def copytree(self, src, dst):
-        """Copy the directory tree rooted at src to dst."""
-        self.src = src
-        self.dst = dst
-        visitfiles(src, self)
+    def dir(self, dir, stats):
+        """Process a directory."""
+        if self.resume(dir, stats):
+            return False
+        return self.newdir(dir, stats)
 
-    def dir(self, dir):
-        """Create destination directory, copying stats and ownership."""
-        dst = re.sub(self.src, self.dst, dir)
+    def file(self, file, stats):
+        """Process a single file."""
+        if not self.resume(file, stats):
+            self.newfile(file, stats)
+
+    def link(self, link, stats):
+        """Process a symbolic link."""
+        if not self.resume(link, stats):
+            self.newlink(link, stats)
+
+    def addcatalog(self, path, stats):
+        """Add the entry at path to the catalog, if one is being written."""
+        if self.catalog is not None:
+            self.catalog.add(path[len(self.src):], stats, self.ostats)
+
+    def newdir(self, dir, stats):
+        """Create destination directory, copying ownership."""
+        self.addcatalog(dir, stats)
+        if self.index is not None:
+            first = self.index.lookup(stats)
+            # When resuming, the directory may be in the index itself.
+            if first is not None and first != self.target(dir):
+                self.linkdir(first, dir, stats)
+                if self.catalog is not None:
+                    # Its contents are not visited, but may have changed.
+                    self.linked.append(dir)
+                return False
+        dst = self.target(dir)
         if self.verbose:
             print "mkdir <%s>" % dst
         if not self.dryrun:
-            os.mkdir(dst)
-            shutil.copystat(dir, dst)
-            stats = os.lstat(dir)
+            if not (self.journal and self.journal.resuming and
+                    os.path.isdir(dst)):
+                opthrottle.wait()
+                os.mkdir(dst)
             chown(dst, stats[stat.ST_UID], stats[stat.ST_GID])
+            runstats.count('dirs')
         if not self.dryrun or self.extattr:
             copyxattr(dir, dst)
-        # Continue traversal...
-        visitfiles(dir, self)
+        # Continue traversal, with the subtree holding up its parent.
+        self.pool.hold(os.path.dirname(dir))
+        self.opened[dir] = errorcount()
+        return True
 
-    def file(self, file):
-        """Process a single file."""
-        dst = re.sub(self.src, self.dst, file)
+    def enddir(self, dir, stats):
+        """Copy the directory stats once its contents have been copied."""
+        # Creating the entries within the directory changes its
+        # modification time, and a read-only mode would prevent
+        # creating them at all, so this must be done last.
+        if self.catalog is not None:
+            self.catalog.enddir(dir[len(self.src):])
+        parent = None if dir == self.src else os.path.dirname(dir)
+        self.pool.finish(dir, parent, self.finishdir,
+                         dir, self.target(dir), stats)
+
+    def finishdir(self, dir, dst, stats):
+        """Copy the permissions and accessed/modified times of dir."""
+        if not self.dryrun:
+            copystat(stats, dst)
+            if errorcount() > self.opened.pop(dir, 0):
+                # Something within may have been missed, so have a resumed
+                # copy go through the directory again.
+                return
+            self.record(dir)
+            if self.index is not None:
+                self.index.add(stats, dst)
+
+    def newfile(self, file, stats):
+        """Copy a file to the destination."""
+        self.addcatalog(file, stats)
+        if self.index is not None and stats[stat.ST_NLINK] > 1:
+            first = self.index.lookup(stats)
+            if first is not None:
+                self.hardlink(first, file)
+                return
+            if not self.index.claim(stats, file):
+                # The inode is being copied already, and will be linked
+                # to once that is done, holding up the directory until then.
+                self.pool.hold(os.path.dirname(file))
+                return
+        dst = self.target(file)
         if self.verbose:
             print "cp <%s> <%s>" % (file, dst)
-        if not self.dryrun:
-            try:
-                # Copy file contents from snapshot to destination.
-                shutil.copyfile(file, dst)
-                # Copy the permissions and accessed/modified times.
-                shutil.copystat(file, dst)
-                # Copy the owner/group values to destination.
-                stats = os.lstat(file)
-                chown(dst, stats[stat.ST_UID], stats[stat.ST_GID])
-            except IOError, e:
-                print "ERROR '{}' processing file {}".format(e, file)
         if not self.dryrun or self.extattr:
-            copyxattr(file, dst)
+            self.pool.schedule(os.path.dirname(file), stats[stat.ST_INO],
+                               self.copyfile, file, dst, stats)
+
+    def copyfile(self, file, dst, stats):
+        """Copy the contents, stats, and attributes of file to dst."""
+        copied = False
+        try:
+            if self.dedup is not None:
+                match = self.dedup.find(file, stats)
+                if match is not None:
+                    self.hardlink(match, file)
+                    copied = True
+                    return
+            if self.dryrun:
+                copyxattr(file, dst)
+            else:
+                try:
+                    # Copy file contents and metadata from snapshot to
+                    # destination, using the open files for the latter.
+                    sha = hashlib.sha1() if self.checksum else None
+                    backend = copier.copy(file, dst, stats, sha)
+                    if self.verbose:
+                        print "copied <%s> using %s" % (dst, backend)
+                except IOError, e:
+                    error(e, file, 'processing file')
+                    return
+                if sha is not None:
+                    self.index.setdigest(stats, sha.hexdigest())
+                self.record(file)
+                runstats.count('copied', stats[stat.ST_SIZE])
+            if self.dedup is not None:
+                self.dedup.add(file, dst, stats)
+            copied = True
+        finally:
+            if self.index is not None and stats[stat.ST_NLINK] > 1:
+                self.linkwaiters(file, dst if copied else None, stats)
+
+    def linkwaiters(self, file, dst, stats):
+        """Link the paths waiting on the copy of file to dst.
+
+        If dst is None, the copy failed and the waiting paths are skipped.
+        """
+        if dst is not None:
+            self.index.add(stats, dst)
+        for waiter in self.index.release(stats):
+            try:
+                if dst is None:
+                    error('copy of {} failed'.format(file), waiter)
+                else:
+                    self.hardlink(dst, waiter)
+            except OSError, e:
+                error(e, waiter)
+            finally:
+                self.pool.release(os.path.dirname(waiter))
 
-    def link(self, link):
+    def newlink(self, link, stats):
         """Copy link to destination."""
+        self.addcatalog(link, stats)
+        if self.index is not None and stats[stat.ST_NLINK] > 1:
+            first = self.index.lookup(stats)
+            if first is not None:
+                self.hardlink(first, link)
+                return
         lnk = os.readlink(link)
-        dst = re.sub(self.src, self.dst, link)
+        dst = self.target(link)
         if self.verbose:
             print "ln -s <%s> <%s>" % (lnk, dst)
         if not self.dryrun:
+            opthrottle.wait()
             os.symlink(lnk, dst)
-            stats = os.lstat(link)
             chown(dst, stats[stat.ST_UID], stats[stat.ST_GID])
         if not self.dryrun or self.extattr:
             copyxattr(link, dst)
+        if not self.dryrun:
+            runstats.count('symlinked')
+            self.record(link)
+            if self.index is not None and stats[stat.ST_NLINK] > 1:
+                self.index.add(stats, dst)
 
 
-class CopyBackupVisitor(TreeVisitor):
+class CopyBackupVisitor(CopyInitialVisitor):
     """Copy a directory tree and its files.
 
     If any entry has the same inode value as the corresponding entry in the
@@ -223,7 +2838,9 @@ class CopyBackupVisitor(TreeVisitor):
 
     """
 
-    def __init__(self, old, prev, curr, verbose, dryrun, extattr):
+    def __init__(self, old, prev, curr, verbose, dryrun, extattr, pool=None,
+                 journal=None, index=None, dedup=None, checksum=False,
+                 farm=None, catalog=None):
         """Initialize a CopyBackupVisitor.
 
         If verbose is True, display operations as they are performed
@@ -232,131 +2849,723 @@ class CopyBackupVisitor(TreeVisitor):
         old is the reference tree to which src will be compared.
         prev is the entry name of the previous backup.
         curr is the entry name of the backup being copied.
+        pool is the CopyPool used to copy files (default copies inline).
+        journal is the Journal in which to record progress, if any.
+        index is the InodeIndex used to find entries to link to, if any.
+        dedup is the DedupCache used to find identical files, if any.
+        If checksum is True, record the digests of the files in the index.
+        farm is the LinkFarm used when directories cannot be linked, if any.
+        catalog is the CatalogWriter to add the entries copied to, if any.
 
         """
-        self.verbose = verbose
-        self.dryrun = dryrun
+        CopyInitialVisitor.__init__(self, verbose, dryrun, extattr, pool,
+                                    journal, index, dedup, checksum, farm,
+                                    catalog)
         self.old = old
         self.prev = prev
         self.curr = curr
-        self.extattr = extattr
+        self.known = None
 
-    def copytree(self, src, dst):
+    def copytree(self, src, dst, changes=None):
         """Copy the tree rooted at src to dst."""
-        self.src = src
-        self.dst = dst
-        visitfiles(src, self)
+        self.odst = os.path.join(os.path.dirname(dst), self.prev)
+        CopyInitialVisitor.copytree(self, src, dst, changes)
+
+    def unchanged(self, path, stats):
+        """Return True if path is the same inode as in the reference tree.
+
+        When replaying recorded changes, known holds the answer already.
+        Either way, ostats is left holding the entry in the reference tree.
+        """
+        if self.known is not None:
+            return self.known
+        self.ostats = lstatold(self.old + path[len(self.src):])
+        return self.ostats is not None and \
+            self.ostats[stat.ST_INO] == stats[stat.ST_INO]
+
+    def relink(self, path):
+        """Hard link the destination entry to the one in the previous copy."""
+        self.hardlink(self.odst + path[len(self.src):], path)
 
-    def dir(self, dir):
+    def newdir(self, dir, stats):
         """Process a directory."""
-        stats = os.lstat(dir)
-        old = re.sub(self.src, self.old, dir)
-        try:
-            ostats = os.lstat(old)
-        except OSError, e:
-            if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EISDIR):
-                # File became directory, or vice versa, or just isn't there.
-                ostats = None
-            else:
-                raise e
-        dst = re.sub(self.src, self.dst, dir)
-        if ostats is None or stats[stat.ST_INO] != ostats[stat.ST_INO]:
-            if self.verbose:
-                print "mkdir <%s>" % dst
-            if not self.dryrun:
-                # Create destination directory, copying stats and ownership.
-                os.mkdir(dst)
-                shutil.copystat(dir, dst)
-                chown(dst, stats[stat.ST_UID], stats[stat.ST_GID])
-            if not self.dryrun or self.extattr:
-                copyxattr(dir, dst)
-            # Continue traversal...
-            visitfiles(dir, self)
-        else:
-            odst = re.sub(self.curr, self.prev, dst)
-            if self.verbose:
-                print "ln <%s> <%s>" % (dst, odst)
-            if not self.dryrun:
-                # Create hard link in destination.
-                link(odst, dst)
-
-    def file(self, file):
+        if self.unchanged(dir, stats):
+            self.linkdir(self.odst + dir[len(self.src):], dir, stats)
+            return False
+        return CopyInitialVisitor.newdir(self, dir, stats)
+
+    def newfile(self, file, stats):
         """Process a file."""
-        stats = os.lstat(file)
-        old = re.sub(self.src, self.old, file)
-        dst = re.sub(self.src, self.dst, file)
-        try:
-            ostats = os.lstat(old)
-        except OSError, e:
-            if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EISDIR):
-                # File became directory, or vice versa, or just isn't there.
-                ostats = None
-            else:
-                raise e
-        if ostats is None or stats[stat.ST_INO] != ostats[stat.ST_INO]:
-            if self.verbose:
-                print "cp <%s> <%s>" % (file, dst)
-            if not self.dryrun:
-                try:
-                    # Copy file contents from snapshot to destination.
-                    shutil.copyfile(file, dst)
-                    # Copy the permissions and accessed/modified times.
-                    shutil.copystat(file, dst)
-                    # Copy the owner/group values to destination.
-                    chown(dst, stats[stat.ST_UID], stats[stat.ST_GID])
-                except IOError, e:
-                    print "ERROR '{}' processing file {}".format(e, file)
-            if not self.dryrun or self.extattr:
-                copyxattr(file, dst)
+        if self.unchanged(file, stats):
+            self.relink(file)
         else:
-            odst = re.sub(self.curr, self.prev, dst)
-            if self.verbose:
-                print "ln <%s> <%s>" % (dst, odst)
-            if not self.dryrun:
-                # Create hard link in destination.
-                link(odst, dst)
-
-    def link(self, link):
+            CopyInitialVisitor.newfile(self, file, stats)
+
+    def newlink(self, link, stats):
         """Process a link."""
-        stats = os.lstat(link)
-        old = re.sub(self.src, self.old, link)
-        dst = re.sub(self.src, self.dst, link)
+        if self.unchanged(link, stats):
+            self.relink(link)
+        else:
+            CopyInitialVisitor.newlink(self, link, stats)
+
+
+class SnapshotFilter:
+    """Selects which of the snapshots of a host to copy.
+
+    Snapshots are selected by a range of dates, then thinned to one per
+    period (the first in each) once older than some number of days, then
+    thinned to every Nth. The newest snapshot in the range is always kept.
+    """
+
+    # The strftime() formats naming the period each snapshot falls in.
+    PERIODS = {'daily': '%Y-%m-%d', 'weekly': '%Y-%W', 'monthly': '%Y-%m',
+               'yearly': '%Y'}
+
+    def __init__(self, since=None, until=None, every=1, thin=()):
+        """Initialize a SnapshotFilter.
+
+        since and until are the dates (YYYY-MM-DD, or the name of a
+        snapshot) of the first and last snapshots to keep, inclusive.
+        thin is a list of (period, days) pairs, where period is one of
+        PERIODS, applied to the snapshots more than days older than the
+        newest one kept. every is N, to keep every Nth snapshot.
+        """
+        self.since = since
+        self.until = until
+        self.every = every
+        self.thin = sorted(thin, key=lambda rule: rule[1], reverse=True)
+
+    def select(self, entries):
+        """Return those of the sorted snapshot names in entries to keep."""
+        if self.since:
+            entries = [e for e in entries if e >= self.since]
+        if self.until:
+            entries = [e for e in entries if e[:len(self.until)] <= self.until]
+        if not entries:
+            return entries
+        if self.thin:
+            newest = snapshottime(entries[-1])
+            seen = set()
+            kept = []
+            for entry in entries:
+                when = snapshottime(entry)
+                if when is None or newest is None:
+                    kept.append(entry)
+                    continue
+                age = (newest - when) / 86400
+                for period, days in self.thin:
+                    if age > days:
+                        key = (period, time.strftime(self.PERIODS[period],
+                                                     time.gmtime(when)))
+                        if key not in seen:
+                            seen.add(key)
+                            kept.append(entry)
+                        break
+                else:
+                    kept.append(entry)
+            entries = kept
+        if self.every > 1:
+            kept = entries[::self.every]
+            if kept[-1] != entries[-1]:
+                kept.append(entries[-1])
+            entries = kept
+        return entries
+
+
+def snapshottime(name):
+    """Return the time of the snapshot called name, or None if unknown."""
+    try:
+        return calendar.timegm(time.strptime(name[:17], '%Y-%m-%d-%H%M%S'))
+    except ValueError:
+        return None
+
+
+def parsethin(val):
+    """Return the (period, days) pairs in val, such as 'weekly:30,daily'.
+
+    Returns None if val is not valid.
+    """
+    rules = []
+    for rule in val.split(','):
+        period, sep, days = rule.partition(':')
+        if period not in SnapshotFilter.PERIODS:
+            return None
         try:
-            ostats = os.lstat(old)
-        except OSError, e:
-            if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EISDIR):
-                # File became directory, or vice versa, or just isn't there.
-                ostats = None
+            days = int(days) if sep else 0
+        except ValueError:
+            return None
+        if days < 0:
+            return None
+        rules.append((period, days))
+    return rules
+
+
+def listsnapshots(src, snapfilter=None, dst=None):
+    """Return the names of the backup snapshots in src, sorted by date.
+
+    If snapfilter is given, only the snapshots it selects are returned,
+    along with those that already exist in dst (if given), such that each
+    is compared with the nearest one before it that is on the target.
+    """
+    entries = os.listdir(src)
+
+    def goodsnap(snap):
+        if snap == '.DS_Store' or snap == 'Latest'\
+                or snap.endswith('.inProgress'):
+            return False
+        return True
+    entries = [entry for entry in entries if goodsnap(entry)]
+    entries.sort()
+    if snapfilter is not None:
+        selected = set(snapfilter.select(entries))
+        entries = [entry for entry in entries if entry in selected or (
+            dst is not None and os.path.isdir(os.path.join(dst, entry)))]
+    return entries
+
+
+def copyhost(src, dst, statedir, verbose, dryrun, extattr, pool, dedup=None,
+             scanners=None, checksum=False, linkfarm=False, catdir=None,
+             snapfilter=None, lookahead=1):
+    """Copy the snapshots of a single host from src to dst.
+
+    pool is the CopyPool used to copy files, and dedup the DedupCache (if
+    any). If scanners is given, it is the multiprocessing pool in which
+    the snapshots are compared ahead of being copied, up to lookahead of
+    them at a time. If checksum is True,
+    the digests of the files copied are recorded for verifying later.
+    If linkfarm is True, unchanged directories are recreated rather than
+    linked, as is done anyway once linking a directory fails. If catdir is
+    given, the catalog of each snapshot copied is written there. If
+    snapfilter is given, only the snapshots it selects are copied.
+    """
+    # Get the list of backup snapshots sorted by name (i.e. date).
+    entries = listsnapshots(src, snapfilter, dst)
+    if not entries:
+        print "No snapshots of %s to copy" % os.path.basename(src)
+        return
+
+    def mkdest(source, target):
+        stats = os.lstat(source)
+        if verbose:
+            print "mkdir <%s>" % target
+        if not dryrun:
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            chown(target, stats[stat.ST_UID], stats[stat.ST_GID])
+        if not dryrun or extattr:
+            copyxattr(source, target)
+    index = None
+    if not dryrun:
+        if not os.path.isdir(statedir):
+            os.makedirs(statedir)
+        # Every source inode is copied once and linked thereafter.
+        index = InodeIndex(os.path.join(statedir, 'inodes.db'), dst)
+        dev = os.lstat(src)[stat.ST_DEV]
+        if index.device() not in (None, dev):
+            print "Source volume of %s mounted anew since last copied" % \
+                os.path.basename(src)
+        index.setdevice(dev)
+    # Decide up front which snapshots will be copied, and with which
+    # journal, so that the scanners need only compare those.
+    journals = {}
+    for entry in entries:
+        journal = None if dryrun else Journal(statedir, entry)
+        if extattr:
+            pass
+        elif journal and journal.iscomplete():
+            print "%s already copied, skipping..." % entry
+            continue
+        elif journal and journal.resuming:
+            print "Resuming backup %s..." % entry
+        elif os.path.exists(os.path.join(dst, entry)):
+            print "%s already exists, skipping..." % entry
+            continue
+        journals[entry] = journal
+    farm = LinkFarm(linkfarm)
+    scans = {}
+    unscanned = collections.deque()
+    if scanners is not None:
+        scanpath = statedir if not dryrun else tempfile.mkdtemp()
+        unscanned.extend((prev, entry) for prev, entry in
+                         zip(entries, entries[1:]) if entry in journals)
+
+    def queuescans():
+        # Compare only a few snapshots ahead, so as not to read the source
+        # far ahead of the copy, nor pile up the changes recorded.
+        while unscanned and len(scans) < lookahead:
+            prev, entry = unscanned.popleft()
+            path = os.path.join(scanpath, entry + '.changes')
+            scans[entry] = scanners.apply_async(scanchanges, (
+                os.path.join(src, prev), os.path.join(src, entry), path))
+    queuescans()
+    prev = None
+    for entry in entries:
+        if entry not in journals:
+            prev = entry
+            continue
+        journal = journals.pop(entry)
+        srcbkup = os.path.join(src, entry)
+        dstbkup = os.path.join(dst, entry)
+        if journal:
+            # Start the journal before anything is written, so that
+            # this snapshot is resumed, not skipped, if interrupted.
+            journal.start()
+        mkdest(srcbkup, dstbkup)
+        catalog = None
+        if catdir is not None and not dryrun and not journal.resuming:
+            # The catalog is written as the snapshot is copied, except
+            # when resuming, as entries copied before would be missed.
+            catalog = CatalogWriter(os.path.join(catdir, entry + '.catalog'),
+                                    prev)
+        changes = None
+        if prev is None:
+            # Copy initial backup.
+            visitor = CopyInitialVisitor(verbose, dryrun, extattr, pool,
+                                         journal, index, dedup, checksum,
+                                         farm, catalog)
+            print "Copying backup %s -- this may take a while..." % entry
+        else:
+            # Copy all subsequent backup snapshots, using the previous
+            # one to determine which entries are hard links.
+            previous = os.path.join(src, prev)
+            visitor = CopyBackupVisitor(previous, prev, entry, verbose,
+                                        dryrun, extattr, pool, journal,
+                                        index, dedup, checksum, farm,
+                                        catalog)
+            if entry in scans:
+                # Use a timeout so that KeyboardInterrupt is not blocked.
+                while not scans[entry].ready():
+                    scans[entry].wait(1)
+                try:
+                    changes = scans.pop(entry).get()
+                except Exception, e:
+                    # Compare the snapshots while copying instead.
+                    error(e, entry, 'comparing')
+                queuescans()
+            print "Copying backup %s..." % entry
+        started = time.time()
+        before = runstats.totals()
+        errors = errorcount()
+        visitor.copytree(srcbkup, dstbkup, changes)
+        runstats.snapshot(os.path.basename(src), entry, started, before)
+        if changes is not None:
+            os.unlink(changes)
+        fixups.retry()
+        if catalog is not None:
+            catalog.close()
+        elif catdir is not None and not dryrun:
+            catalogsnapshot(os.path.join(src, prev) if prev else None,
+                            srcbkup, os.path.join(catdir, entry + '.catalog'))
+        if index:
+            index.commit()
+        if journal:
+            if errorcount() > errors:
+                # Leave the journal, so that the next run resumes the copy.
+                print "WARNING: errors copying %s, run again to finish " \
+                    "copying it" % entry
             else:
-                raise e
-        if ostats is None or stats[stat.ST_INO] != ostats[stat.ST_INO]:
-            lnk = os.readlink(link)
-            if self.verbose:
-                print "ln -s <%s> <%s>" % (lnk, dst)
-            if not self.dryrun:
-                # Copy link to destination.
-                os.symlink(lnk, dst)
-                chown(dst, stats[stat.ST_UID], stats[stat.ST_GID])
-            if not self.dryrun or self.extattr:
-                copyxattr(link, dst)
+                journal.complete()
+        farm.rotate()
+        prev = entry
+    if index:
+        index.close()
+    if scanners is not None and dryrun:
+        os.rmdir(scanpath)
+    # Create Latest symlink pointing to last entry.
+    latest = os.path.join(dst, 'Latest')
+    if verbose:
+        print "ln -s <%s> <%s>" % (entries[-1], latest)
+    if not dryrun:
+        if os.path.lexists(latest):
+            # Seems root cannot delete the symlink, so have the real
+            # user perform the delete for us.
+            user = subprocess.Popen(
+                ["who", "am", "i"], stdout=subprocess.PIPE
+                ).communicate()[0]
+            user = user.split()[0]
+            os.system("sudo -u %s unlink %s" % (user, latest))
+        os.symlink(entries[-1], latest)
+
+
+def planbackupdb(srcdb, dstdb, dstbase, hosts, snapfilter=None):
+    """Print what copying the snapshots (selected by snapfilter) entails.
+
+    Returns the totals for all of the snapshots, as from Planner.plan().
+    """
+    planner = Planner()
+    grand = None
+    print "%-32s %16s %10s %10s %10s %10s" % (
+        "Snapshot", "Bytes", "Files", "Links", "Symlinks", "Dirs")
+    for host in hosts:
+        snapshots = plansnapshots(
+            os.path.join(srcdb, host), os.path.join(dstdb, host),
+            os.path.join(dstbase, '.timecopy', host), planner, snapfilter)
+        for entry, totals in snapshots:
+            print "%-32s %16d %10d %10d %10d %10d" % (
+                os.path.join(host, entry), totals['bytes'], totals['files'],
+                totals['links'], totals['symlinks'], totals['dirs'])
+            if grand is None:
+                grand = dict(totals)
+            else:
+                for key in grand:
+                    grand[key] += totals[key]
+    if grand is None:
+        grand = dict.fromkeys(('bytes', 'blocks', 'files', 'links',
+                               'symlinks', 'dirs'), 0)
+    print "%-32s %16d %10d %10d %10d %10d" % (
+        "Total", grand['bytes'], grand['files'], grand['links'],
+        grand['symlinks'], grand['dirs'])
+    vfs = os.statvfs(dstbase)
+    available = vfs.f_bavail * vfs.f_frsize
+    print "Projected size of copy: %d bytes (%d bytes available)" % (
+        grand['blocks'], available)
+    if grand['blocks'] > available:
+        print "WARNING: the copy will not fit on %s!" % dstbase
+    return grand
+
+
+class SpaceVisitor(TreeVisitor):
+    """Works out how much space each snapshot takes up on its own.
+
+    The snapshots of a host are visited in order, once each. Directories
+    that Time Machine linked from an earlier snapshot are not descended
+    into; instead, everything within them becomes shared. The bytes of a
+    file are unique to the first snapshot it is found in until it is found
+    in another, so the files with more than one link are remembered, by
+    inode, as a tuple of the directory first holding them, the snapshot
+    last holding them and the number of links found. Links within linked
+    directories are never visited, so few files ever have all of their
+    links found, and memory grows with the number of such files (not with
+    the number of entries, as most are in linked directories).
+
+    Each directory is remembered as a list of its parent, name, snapshot,
+    and the unique and total bytes within it, the latter being added to
+    its parent once the directory has been visited. Whatever becomes
+    shared later is taken out of the unique bytes of the directories
+    above it, up to the root of its snapshot.
+    """
+
+    PARENT, NAME, SNAPSHOT, UNIQUE, TOTAL, SHARED = range(6)
+
+    def __init__(self):
+        """Initialize a SpaceVisitor."""
+        self.dirs = {}
+        self.links = {}
+        self.roots = []
+
+    def walk(self, src):
+        """Visit the snapshot at src, after those visited already."""
+        key = os.lstat(src)[stat.ST_INO]
+        self.snapshot = len(self.roots)
+        self.roots.append(key)
+        self.dirs[key] = [None, os.path.basename(src), self.snapshot, 0, 0,
+                          False]
+        self.parents = {src: key}
+        visitfiles(src, self, pathrules)
+
+    def usage(self, stats):
+        """Return the number of bytes the entry takes up on disk."""
+        blocks = getattr(stats, 'st_blocks', None)
+        return stats[stat.ST_SIZE] if blocks is None else blocks * 512
+
+    def share(self, key, size):
+        """Take size bytes, now shared, out of directory key and above."""
+        chain = []
+        while key is not None:
+            node = self.dirs[key]
+            if node[self.SHARED]:
+                # Already taken out along with this directory.
+                return
+            chain.append(node)
+            key = node[self.PARENT]
+        for node in chain:
+            node[self.UNIQUE] -= size
+
+    def dir(self, dir, stats):
+        """Count a directory, descending only if not seen before."""
+        key = stats[stat.ST_INO]
+        parent = self.parents[os.path.dirname(dir)]
+        node = self.dirs.get(key)
+        if node is not None:
+            if node[self.SNAPSHOT] != self.snapshot:
+                self.share(key, node[self.UNIQUE])
+                node[self.SHARED] = True
+            self.dirs[parent][self.TOTAL] += node[self.TOTAL]
+            return False
+        size = self.usage(stats)
+        self.dirs[key] = [parent, os.path.basename(dir), self.snapshot, size,
+                          size, False]
+        self.parents[dir] = key
+        return True
+
+    def enddir(self, dir, stats):
+        """Add the bytes within the directory to its parent."""
+        node = self.dirs[self.parents.pop(dir)]
+        parent = self.dirs[node[self.PARENT]]
+        parent[self.UNIQUE] += node[self.UNIQUE]
+        parent[self.TOTAL] += node[self.TOTAL]
+
+    def file(self, file, stats):
+        """Count a file, as unique unless found in another snapshot."""
+        size = self.usage(stats)
+        parent = self.parents[os.path.dirname(file)]
+        node = self.dirs[parent]
+        nlink = stats[stat.ST_NLINK]
+        if nlink > 1:
+            key = stats[stat.ST_INO]
+            # The directory the file was first found in (None once the
+            # file is shared), the last snapshot, and the links found.
+            entry = self.links.get(key)
+            if entry is not None:
+                first, last, found = entry
+                if found + 1 >= nlink:
+                    # No more links to be found.
+                    del self.links[key]
+                else:
+                    self.links[key] = (first if last == self.snapshot
+                                       else None, self.snapshot, found + 1)
+                if last == self.snapshot:
+                    return
+                if first is not None:
+                    self.share(first, size)
+                node[self.TOTAL] += size
+                return
+            self.links[key] = (parent, self.snapshot, 1)
+        node[self.UNIQUE] += size
+        node[self.TOTAL] += size
+
+    link = file
+
+    def path(self, key):
+        """Return the path of directory key, starting with its snapshot.
+
+        Returns None if the directory, or any directory above it, has
+        been shared since.
+        """
+        names = []
+        while key is not None:
+            node = self.dirs[key]
+            if node[self.SHARED]:
+                return None
+            names.append(node[self.NAME])
+            key = node[self.PARENT]
+        return '/'.join(reversed(names))
+
+    def top(self, count, depth=None):
+        """Return the (path, bytes) of the count most unique directories.
+
+        That is, those holding the most bytes unique to their snapshot,
+        no deeper than depth (if given).
+        """
+        def rows():
+            for key, node in self.dirs.iteritems():
+                if node[self.UNIQUE] <= 0 or node[self.PARENT] is None:
+                    continue
+                path = self.path(key)
+                if path is None:
+                    continue
+                if depth is None or path.count('/') <= depth:
+                    yield path, node[self.UNIQUE]
+        return heapq.nlargest(count, rows(), key=lambda row: row[1])
+
+
+def spacebackupdb(srcbase, depth=None, top=10, snapfilter=None):
+    """Print the space that each snapshot in srcbase takes up on its own.
+
+    That is, the bytes in the snapshot that no other snapshot shares, and
+    would be freed by deleting it, along with those that it shares. The
+    top directories holding the most unique bytes (no deeper than depth,
+    if given) are listed after. snapfilter, if given, selects the
+    snapshots visited (and so which share with each other).
+    """
+    srcdb = os.path.join(srcbase, 'Backups.backupdb')
+    if not os.path.exists(srcdb):
+        print "ERROR: %s does not contain a Time Machine backup!" % srcbase
+        sys.exit(2)
+    for host in listhosts(srcdb):
+        src = os.path.join(srcdb, host)
+        visitor = SpaceVisitor()
+        entries = listsnapshots(src, snapfilter)
+        for entry in entries:
+            print "Visiting backup %s..." % entry
+            visitor.walk(os.path.join(src, entry))
+        print "==> Space used by the snapshots of %s" % host
+        print "%-24s %11s %11s %11s" % ("Snapshot", "Unique", "Shared",
+                                        "Total")
+        print "=" * 24 + (" " + "=" * 11) * 3
+        unique = 0
+        for entry, key in zip(entries, visitor.roots):
+            node = visitor.dirs[key]
+            print "%-24s %11s %11s %11s" % (
+                entry, formatsize(node[visitor.UNIQUE]),
+                formatsize(node[visitor.TOTAL] - node[visitor.UNIQUE]),
+                formatsize(node[visitor.TOTAL]))
+            unique += node[visitor.UNIQUE]
+        print "==> Total unique: %s" % formatsize(unique)
+        if top:
+            print "==> Top directories by unique bytes"
+            for path, size in visitor.top(top, depth):
+                print "%11s %s" % (formatsize(size), path)
+
+
+class VerifyVisitor(TreeVisitor):
+    """Verifies that a snapshot was copied correctly.
+
+    Every entry in the source must exist in the target, with the same type
+    (and size, for files). Entries sharing an inode in the source must be
+    linked to the entry first written for that inode, as recorded in the
+    InodeIndex, and directories linked in this way are not descended into
+    again (unlike those recreated by a LinkFarm). The contents of each
+    file copied (rather than linked) are then digested, in the pool, and
+    compared with the digest recorded while it was being copied; when none
+    was recorded, the source is digested too.
+    """
+
+    def __init__(self, index, pool=None, sample=100):
+        """Initialize a VerifyVisitor.
+
+        index is the InodeIndex written by the copy, or None if there is
+        none, in which case the links are not checked. pool is the CopyPool
+        in which to compare the contents. Only a random sample percent of
+        the files have their contents compared.
+        """
+        self.index = index
+        self.pool = pool or CopyPool()
+        self.sample = sample
+
+    def verify(self, src, dst):
+        """Verify the tree at dst is a copy of that at src."""
+        self.src = src
+        self.dst = dst
+        visitfiles(src, self, pathrules)
+        self.pool.join()
+
+    def mismatch(self, path, reason):
+        """Report that the copy of path does not match."""
+        print "MISMATCH '{}' verifying {}".format(reason, path)
+        runstats.count('mismatched')
+
+    def check(self, path, stats):
+        """Check the copy of path, returning True if it needs a closer look.
+
+        That is, if it matches so far and was not linked to an entry that
+        was already verified.
+        """
+        dst = self.dst + path[len(self.src):]
+        try:
+            dstats = os.lstat(dst)
+        except OSError, e:
+            self.mismatch(path, e)
+            return False
+        mode = stats[stat.ST_MODE]
+        if stat.S_IFMT(mode) != stat.S_IFMT(dstats[stat.ST_MODE]):
+            self.mismatch(path, 'type differs')
+            return False
+        if stat.S_ISREG(mode) and stats[stat.ST_SIZE] != dstats[stat.ST_SIZE]:
+            self.mismatch(path, 'size differs')
+            return False
+        runstats.count('verified')
+        if self.index is None or not (stat.S_ISDIR(mode) or
+                                      stats[stat.ST_NLINK] > 1):
+            return True
+        first = self.index.lookup(stats)
+        if first is None:
+            self.mismatch(path, 'not in inode index')
+            return False
+        if first == dst:
+            return True
+        if os.lstat(first)[stat.ST_INO] == dstats[stat.ST_INO]:
+            return False
+        if stat.S_ISDIR(mode):
+            # Recreated by a LinkFarm, so check what is within.
+            return True
+        self.mismatch(path, 'not linked to %s' % first)
+        return False
+
+    def dir(self, dir, stats):
+        """Check a directory, descending into it unless already verified."""
+        return self.check(dir, stats)
+
+    def file(self, file, stats):
+        """Check a file, comparing the contents of a sample of them."""
+        if not self.check(file, stats):
+            return
+        if self.sample >= 100 or random.random() * 100 < self.sample:
+            self.pool.submit(os.path.dirname(file), self.compare, file,
+                             self.dst + file[len(self.src):], stats)
+
+    def link(self, link, stats):
+        """Check a symbolic link."""
+        self.check(link, stats)
+
+    def compare(self, file, dst, stats):
+        """Compare the digest of the contents of dst with that of file."""
+        digest = None
+        if self.index is not None:
+            digest = self.index.digest(stats)
+        if digest is None:
+            digest = filedigest(file)
+        if filedigest(dst) != digest:
+            self.mismatch(file, 'contents differ')
         else:
-            odst = re.sub(self.curr, self.prev, dst)
-            if self.verbose:
-                print "ln <%s> <%s>" % (dst, odst)
-            if not self.dryrun:
-                # Create hard link in destination.
-                link(odst, dst)
+            runstats.count('compared', stats[stat.ST_SIZE])
 
 
-def copybackupdb(srcbase, dstbase, verbose, dryrun, extattr):
-    """Copy the backup database found in srcbase to dstbase."""
-    # Validate that srcbase contains a backup database.
+def verifybackupdb(srcbase, dstbase, jobs=1, sample=100, snapfilter=None):
+    """Verify that the backup database in dstbase is a copy of srcbase.
+
+    Up to jobs files are compared at once, out of a random sample percent
+    of them. If snapfilter is given, only the snapshots it selects are
+    verified. Returns True if everything that was checked matches.
+    """
     srcdb = os.path.join(srcbase, 'Backups.backupdb')
     if not os.path.exists(srcdb):
         print "ERROR: %s does not contain a Time Machine backup!" % srcbase
         sys.exit(2)
     dstdb = os.path.join(dstbase, 'Backups.backupdb')
-    # Get a list of entries in the backupdb (typically just one).
+    pool = CopyPool(jobs)
+    for host in listhosts(srcdb):
+        src = os.path.join(srcdb, host)
+        dst = os.path.join(dstdb, host)
+        path = os.path.join(dstbase, '.timecopy', host, 'inodes.db')
+        index = None
+        if os.path.exists(path):
+            index = InodeIndex(path, dst)
+        else:
+            print "No inode index for %s, not checking links" % host
+        entries = listsnapshots(src, snapfilter)
+        if index is not None and \
+                index.device() not in (None, os.lstat(src)[stat.ST_DEV]) \
+                and not any(index.lookup(os.lstat(os.path.join(src, entry)))
+                            for entry in entries):
+            # Not merely mounted anew, as none of the snapshots are there.
+            error('inode index is for another source volume, '
+                  'not checking links', path)
+            index.close()
+            index = None
+        visitor = VerifyVisitor(index, pool, sample)
+        for entry in entries:
+            if not os.path.isdir(os.path.join(dst, entry)):
+                visitor.mismatch(os.path.join(src, entry), 'missing')
+                continue
+            print "Verifying backup %s..." % entry
+            visitor.verify(os.path.join(src, entry), os.path.join(dst, entry))
+        if index:
+            index.close()
+    pool.close()
+    totals = runstats.totals()
+    print "Verified %d entries, compared %d files (%d bytes)" % (
+        totals.get('verified', (0, 0))[0], totals.get('compared', (0, 0))[0],
+        totals.get('compared', (0, 0))[1])
+    mismatched = totals.get('mismatched', (0, 0))[0] + \
+        totals.get('errors', (0, 0))[0]
+    if mismatched:
+        print "Found %d problems" % mismatched
+    return not mismatched
+
+
+def listhosts(srcdb):
+    """Return the names of the hosts backed up in srcdb."""
     hosts = os.listdir(srcdb)
 
     def goodhost(host):
@@ -365,72 +3574,100 @@ def copybackupdb(srcbase, dstbase, verbose, dryrun, extattr):
         if len(host) > 0 and host[0] != '.' and stat.S_ISDIR(mode):
             return True
         return False
-    hosts = [host for host in hosts if goodhost(host)]
-    for host in hosts:
-        # Get the list of backup snapshots sorted by name (i.e. date).
-        src = os.path.join(srcdb, host)
-        entries = os.listdir(src)
+    return [host for host in hosts if goodhost(host)]
 
-        def goodsnap(snap):
-            if snap == '.DS_Store' or snap == 'Latest'\
-                    or snap.endswith('.inProgress'):
-                return False
-            return True
-        entries = [entry for entry in entries if goodsnap(entry)]
-        entries.sort()
 
-        def mkdest(source, target):
-            stats = os.lstat(source)
-            if verbose:
-                print "mkdir <%s>" % target
-            if not dryrun:
-                os.makedirs(target)
-                shutil.copystat(source, target)
-                chown(target, stats[stat.ST_UID], stats[stat.ST_GID])
-            if not dryrun or extattr:
-                copyxattr(source, target)
-        # Copy initial backup.
-        dst = os.path.join(dstdb, host)
-        srcbkup = os.path.join(src, entries[0])
-        dstbkup = os.path.join(dst, entries[0])
-        if not extattr and os.path.exists(dstbkup):
-            print "%s already exists, skipping..." % entries[0]
+def copybackupdb(srcbase, dstbase, verbose, dryrun, extattr, jobs=1,
+                 dedup=False, pipeline=0, statsfile=None, plan=False,
+                 progress=False, checksum=False, window=0, adaptive=False,
+                 linkfarm=False, catalog=None, snapfilter=None):
+    """Copy the backup database found in srcbase to dstbase.
+
+    Up to jobs files are copied concurrently. If dedup is True, files with
+    identical contents and metadata are linked rather than copied again.
+    If pipeline is non-zero, that many processes compare the snapshots
+    ahead of them being copied, and all hosts are copied concurrently.
+    If statsfile is given, statistics are written there as JSON lines.
+    If plan is True, just print what the copy entails; if progress is
+    True, do that and then periodically print the progress of the copy.
+    If checksum is True, record the digests of the files for --verify.
+    If window is non-zero, files are copied in batches of that many, in
+    the order of their inode numbers. If adaptive is True, the number of
+    files copied at once is adjusted to what gets the most done.
+    If linkfarm is True, directories are never hard linked on the target.
+    If catalog is given, the catalogs of the snapshots are written to a
+    directory for each host within it. If snapfilter is given, only the
+    snapshots it selects are copied.
+    """
+    # Validate that srcbase contains a backup database.
+    srcdb = os.path.join(srcbase, 'Backups.backupdb')
+    if not os.path.exists(srcdb):
+        print "ERROR: %s does not contain a Time Machine backup!" % srcbase
+        sys.exit(2)
+    dstdb = os.path.join(dstbase, 'Backups.backupdb')
+    # Get a list of entries in the backupdb (typically just one).
+    hosts = listhosts(srcdb)
+    # Start the scanner processes before any threads, so that none of
+    # them can be forked holding a lock (such as that of runstats).
+    scanners = None
+    if pipeline and not plan:
+        scanners = multiprocessing.Pool(pipeline)
+    if plan or progress:
+        totals = planbackupdb(srcdb, dstdb, dstbase, hosts, snapfilter)
+        if plan:
+            return
+        progress = Progress(totals)
+        progress.start()
+    if statsfile is not None:
+        runstats.open(statsfile)
+    dedup = DedupCache() if dedup and not dryrun else None
+    threads = []
+    pools = []
+    controllers = []
+    failed = []
+
+    def copyhostthread(*args):
+        # An exception would otherwise end the thread without a trace.
+        try:
+            copyhost(*args)
+        except Exception:
+            traceback.print_exc()
+            failed.append(os.path.basename(args[0]))
+    for host in hosts:
+        catdir = None
+        if catalog is not None and not dryrun:
+            catdir = os.path.join(catalog, host)
+            if not os.path.isdir(catdir):
+                os.makedirs(catdir)
+        args = (os.path.join(srcdb, host), os.path.join(dstdb, host),
+                os.path.join(dstbase, '.timecopy', host),
+                verbose, dryrun, extattr, CopyPool(jobs, window), dedup,
+                scanners, checksum, linkfarm, catdir, snapfilter, pipeline)
+        pools.append(args[6])
+        if adaptive and jobs > 1:
+            controllers.append(Controller(args[6]))
+            controllers[-1].start()
+        if scanners is None:
+            copyhost(*args)
         else:
-            mkdest(srcbkup, dstbkup)
-            visitor = CopyInitialVisitor(verbose, dryrun, extattr)
-            print "Copying backup %s -- this may take a while..." % entries[0]
-            visitor.copytree(srcbkup, dstbkup)
-        # Copy all subsequent backup snapshots.
-        prev = entries[0]
-        for entry in entries[1:]:
-            # Here previous is the backup before the one we are about to
-            # copy; it is used to determine which entries are hard links.
-            previous = srcbkup
-            srcbkup = os.path.join(src, entry)
-            dstbkup = os.path.join(dst, entry)
-            if not extattr and os.path.exists(dstbkup):
-                print "%s already exists, skipping..." % entry
-            else:
-                mkdest(srcbkup, dstbkup)
-                visitor = CopyBackupVisitor(previous, prev, entry,
-                                            verbose, dryrun, extattr)
-                print "Copying backup %s..." % entry
-                visitor.copytree(srcbkup, dstbkup)
-            prev = entry
-        # Create Latest symlink pointing to last entry.
-        latest = os.path.join(dst, 'Latest')
-        if verbose:
-            print "ln -s <%s> <%s>" % (entries[-1], latest)
-        if not dryrun:
-            if os.path.lexists(latest):
-                # Seems root cannot delete the symlink, so have the real
-                # user perform the delete for us.
-                user = subprocess.Popen(
-                    ["who", "am", "i"], stdout=subprocess.PIPE
-                    ).communicate()[0]
-                user = user.split()[0]
-                os.system("sudo -u %s unlink %s" % (user, latest))
-            os.symlink(entries[-1], latest)
+            # The hosts are independent, so copy them all at once.
+            thread = threading.Thread(target=copyhostthread, args=args)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        # Use a timeout so that KeyboardInterrupt is not blocked.
+        while thread.is_alive():
+            thread.join(1)
+    for controller in controllers:
+        controller.stop()
+    for pool in pools:
+        pool.close()
+    if scanners is not None:
+        scanners.close()
+        scanners.join()
+    if progress:
+        progress.stop()
     # Copy the MAC address dotfile(s) that TM creates.
     entries = os.listdir(srcbase)
     regex = re.compile('^\.[0-9a-f]{12}$')
@@ -442,19 +3679,44 @@ def copybackupdb(srcbase, dstbase, verbose, dryrun, extattr):
                 print "cp <%s> <%s>" % (src, dst)
             if not dryrun:
                 try:
-                    shutil.copyfile(src, dst)
-                    shutil.copystat(src, dst)
                     stats = os.lstat(src)
-                    chown(dst, stats[stat.ST_UID], stats[stat.ST_GID])
+                    copier.copy(src, dst, stats)
+                    runstats.count('copied', stats[stat.ST_SIZE])
                 except IOError, e:
-                    print "ERROR '{}' processing file {}".format(e, src)
-            if not dryrun or extattr:
+                    error(e, src, 'processing file')
+            elif extattr:
                 copyxattr(src, dst)
+    copier.report()
+    fixups.report()
+    if dedup:
+        dedup.report()
+    runstats.report()
+    if failed:
+        print "ERROR: copying %s failed" % ', '.join(failed)
+        sys.exit(1)
 
 
 def usage():
     """Display a usage summary."""
-    print """Usage: timecopy.py [-hnvx] [--nochown] <source> <target>
+    print """Usage: timecopy.py [-hnvx] [-j N] [-p N] [--adaptive]
+                   [--bwlimit RATE] [--catalog DIR] [--checksum] [--dedup]
+                   [--every N] [--exclude PATTERN] [--exclude-from FILE]
+                   [--include PATH] [--linkfarm] [--nochown] [--opslimit N]
+                   [--ordered N] [--plan] [--progress] [--since DATE]
+                   [--stats FILE] [--thin SPEC] [--until DATE]
+                   <source> <target>
+       timecopy.py --verify [-j N] [--sample PERCENT] [--since DATE]
+                   [--until DATE] [--every N] [--thin SPEC]
+                   [--exclude PATTERN] [--exclude-from FILE]
+                   [--include PATH] <source> <target>
+       timecopy.py --changes [-d N] [-m SIZE] [--sort KEY] [--top N]
+                   [--nosymlinks] [--exclude PATTERN] [--exclude-from FILE]
+                   [--include PATH] <previous> <current>
+       timecopy.py --changes [...] <catalog>
+       timecopy.py --catalog DIR [--exclude PATTERN] [--exclude-from FILE]
+                   [--include PATH] <source>
+       timecopy.py --history PATH <catalogs>
+       timecopy.py --space [-d N] [--top N] <source>
 
 Copies a Mac OS X Time Machine volume (set of backups) from one location
 to another, such as from one disk to another, or from one disk image to
@@ -472,9 +3734,123 @@ Time Machine backups will be copied. You must have sufficient privileges
 to write to this location. Chances are you will need to be using `sudo`
 to gain the necessary privileges, unless -n or --dry-run is given.
 
+Progress is recorded in a '.timecopy' directory in the <target>. If the
+copy is interrupted, running the same command again will resume copying
+the snapshot where it left off, and skip those that were completed.
+
+When only some of the snapshots are copied (see --every, --since, --thin,
+and --until), each is compared with the nearest one before it that is on
+the <target>, rather than with the one before it in the <source>, so that
+everything that did not change between the two is still linked.
+
+With --changes, nothing is copied; instead the entries that changed from
+the <previous> snapshot to the <current> one (e.g. the directories
+2017-03-01-104512 and 2017-03-02-104733 within Backups.backupdb/gojira)
+are listed along with their old and new sizes, as timedog does.
+
+With --catalog DIR, a catalog of these changes is written for each
+snapshot, to DIR/<host>/<snapshot>.catalog, while copying, or without
+copying when no <target> is given. Given a <catalog> file in place of
+the two snapshots, --changes then reads only the catalog, without the
+volume being mounted at all. Likewise, --history lists the snapshots in
+which the entry at PATH (within a snapshot) changed, the first being the
+one in which it appeared, from the <catalogs> of a host.
+
+With --verify, nothing is copied either; instead the <target> is checked
+against the <source>, as described below.
+
+With --space, nothing is copied either; instead the snapshots of each
+host in the <source> are visited once each, to report how much space
+each snapshot takes up on its own (that is, what deleting it would free),
+and how much it shares with the others. The --top N directories (10 by
+default) holding the most bytes unique to their snapshot, no deeper than
+-d N, if given, are listed too.
+
+--adaptive
+\tWith -j N, vary the number of files copied at the same time, from
+\tone up to N, measuring how much gets done, to find the most that
+\tthe <target> can sustain, and backing off when it gets slower. The
+\tother changes to the <target> (creating directories and links, and
+\tsetting owners) are made one at a time as the snapshot is traversed,
+\tand are limited only by --opslimit, not adjusted.
+
+--bwlimit RATE
+\tCopy no more than RATE bytes per second, or K, M, or G bytes per
+\tsecond when followed by that letter, so as to leave a share of a
+\tnetwork or disk to others.
+
+--changes
+\tList the changes between two snapshots, rather than copying.
+
+-d|--depth N
+\tWith --changes, sum up the changes deeper than N directories into a
+\tsingle line for their directory at that depth. With --space, list
+\tno directories deeper than N.
+
+--catalog DIR
+\tWrite a catalog of the changes in each snapshot copied to DIR, to be
+\tread by --changes and --history later.
+
+--checksum
+\tRecord the digests of the contents of the files as they are copied,
+\tfor --verify to compare with later. Digesting means reading the files
+\tinto memory, rather than having the kernel copy them.
+
+--dedup
+\tLink files that have the same contents, size, modification time,
+\tpermissions, ownership, and extended attributes as a file that was
+\talready copied, even if they are not the same file in the source.
+\tThis reads such files twice (once to compare), but saves writing
+\tthem and the space they would take up on the target.
+
+--every N
+\tCopy only every Nth snapshot (and the newest) of those selected.
+
+--exclude PATTERN
+\tLeave out the entries matching PATTERN, which may be given more than
+\tonce. A PATTERN without a slash matches names at any depth, such as
+\t'.Trash', 'Caches', or '*.tmp'; any other matches the whole path
+\twithin a snapshot, such as '/*/Users/*/Library/Logs'. '*' and '?'
+\tmatch within a single name, '**' matches across any number of them,
+\tand a trailing slash matches only directories. Directories left out
+\tare not read at all. The same rules must be given when resuming or
+\tadding to a copy, as unchanged directories are linked as they were.
+\tThe rules leave the entries out of --changes and --catalog as well.
+
+--exclude-from FILE
+\tRead patterns for --exclude from FILE, one per line, ignoring blank
+\tlines and those starting with '#'. Lines starting with '+ ' are paths
+\tfor --include instead.
+
 -h|--help
 \tPrints this usage information.
 
+--include PATH
+\tCopy only what is within PATH, which is the path of a directory or
+\tfile within a snapshot, such as '/Macintosh HD/Users', and may be given
+\tmore than once. Whatever --exclude matches is still left out.
+
+--linkfarm
+\tNever hard link directories on the <target>; instead, recreate the
+\tdirectories that did not change since the previous snapshot, hard
+\tlinking everything within them to the copy of that snapshot, without
+\treading the <source>. This is done anyway once linking a directory
+\tfails, as it does on most file systems other than HFS+.
+
+-m|--minsize SIZE
+\tWith --changes, leave out lines whose new size is less than SIZE,
+\twhich is in bytes, or in K, M, G, or T when followed by that letter.
+
+--nosymlinks
+\tWith --changes, leave out symbolic links, which Time Machine copies
+\tanew in every snapshot.
+
+-j|--jobs N
+\tCopy up to N files at the same time (default 1). Directories and
+\thard links are still created in order by a single thread; only the
+\tfile copies are done in parallel, which helps keep slow (e.g. network
+\tor USB) target volumes busy.
+
 -n|--dry-run
 \tDo not make any changes on disk.
 
@@ -482,6 +3858,81 @@ to gain the necessary privileges, unless -n or --dry-run is given.
 \tDo not use chown to change the owner/group of the destination
 \tfiles. Generally only root can do that, and on network volumes
 \tthe Mac will make everything owned by the 'unknown' user anyway.
+\tThis is assumed once the first few changes of owner all fail to
+\ttake effect; other failures are retried at the end of each snapshot.
+
+--plan
+\tDo not copy anything, but work out what the copy entails, from the
+\tstats of the entries alone: for each snapshot still to be copied, the
+\tnumber of bytes to copy, and the files, links, symlinks and dirs to be
+\tcreated. Reports the projected size of the copy, and whether it will
+\tfit in the space available on the <target>.
+
+--progress
+\tWork out what the copy entails, as with --plan, then copy, printing
+\tthe percentage done and an estimate of the time remaining every 30
+\tseconds.
+
+--opslimit N
+\tPerform no more than N metadata operations (creating directories and
+\tlinks, changing owners, permissions, times, and extended attributes)
+\tper second on the <target>.
+
+--ordered N
+\tCopy the files in batches of N, in the order of their inode numbers,
+\trather than in the order they are found. On rotating (and especially
+\tfragmented) source disks, this follows the placement of the files on
+\tthe disk more closely, reducing the time spent seeking. A window of a
+\tfew thousand files is a good start.
+
+-p|--pipeline N
+\tCompare each snapshot with the one before it in N separate processes,
+\tahead of copying it, such that finding the changes in the snapshots
+\tto come overlaps with copying the current one. When there are backups
+\tof several hosts, they are also copied at the same time.
+
+--sample PERCENT
+\tWith --verify, compare the contents of only a random sample of
+\tPERCENT of the files. Every entry is still checked for being there,
+\twith the same type, size, and links.
+
+--since DATE
+\tCopy only the snapshots taken on or after DATE (as YYYY-MM-DD or the
+\tname of a snapshot).
+
+--sort KEY
+\tWith --changes, sort the lines by 'old' size, 'new' size, or 'name'
+\t(the default).
+
+--stats FILE
+\tAppend statistics to FILE as JSON objects, one per line: the number
+\tof entries (and bytes) copied, linked, and so on, with the latency of
+\teach kind of file system operation, every ten seconds; the same for
+\teach snapshot once it has been copied; and a summary at the end.
+
+--thin SPEC
+\tCopy only the first snapshot of each day, week, month, or year, for
+\tthose older than some number of days (relative to the newest one).
+\tSPEC is a list of PERIOD:DAYS separated by commas, where PERIOD is
+\t'daily', 'weekly', 'monthly', or 'yearly'. For example,
+\t'daily:7,weekly:30,monthly:365' keeps everything from the last week,
+\tdaily snapshots for a month, weekly ones for a year, and monthly ones
+\tbefore that.
+
+--top N
+\tWith --changes, list only the N lines with the largest sizes. With
+\t--space, list the N directories holding the most unique bytes.
+
+--until DATE
+\tCopy only the snapshots taken on or before DATE.
+
+--verify
+\tCheck that the <target> is a copy of the <source>: that each entry
+\twas copied, with the same type (and size); that the entries sharing
+\tan inode in the source share one in the target as well; and that the
+\tcontents of each file match the digest recorded by --checksum (or,
+\twithout one, those of the source). With -j N, N files are compared at
+\tthe same time. Exits with status 1 if any problems are found.
 
 -v|--verbose
 \tPrints information about what the script is doing at each step.
@@ -496,11 +3947,27 @@ to gain the necessary privileges, unless -n or --dry-run is given.
 \tthe copy using some other means."""
 
 
+def parsesize(val):
+    """Return the number of bytes in val, such as '512', '1.5M', or None."""
+    match = re.match(r'^([0-9.]+)([KMGT]?)$', val, re.IGNORECASE)
+    try:
+        return int(float(match.group(1)) * 1024 ** (
+            ' KMGT'.index(match.group(2).upper() or ' ')))
+    except (AttributeError, ValueError):
+        return None
+
+
 def main():
     """Parse command line arguments and do the work."""
     # Parse the command line arguments.
-    shortopts = "hnvx"
-    longopts = ["help", "dry-run", "nochown", "verbose", "xattr"]
+    shortopts = "d:hj:m:np:vx"
+    longopts = ["adaptive", "bwlimit=", "catalog=", "changes", "checksum",
+                "dedup", "depth=", "every=", "exclude=", "exclude-from=",
+                "help", "history=", "include=", "jobs=", "dry-run",
+                "linkfarm", "minsize=", "nochown", "nosymlinks",
+                "opslimit=", "ordered=", "pipeline=", "plan", "progress",
+                "sample=", "since=", "sort=", "space", "stats=", "thin=",
+                "top=", "until=", "verbose", "verify", "xattr"]
     try:
         opts, args = getopt.getopt(sys.argv[1:], shortopts, longopts)
     except getopt.GetoptError, err:
@@ -510,18 +3977,179 @@ def main():
     verbose = False
     dryrun = False
     extattr = False
+    jobs = 1
+    dedup = False
+    pipeline = 0
+    statsfile = None
+    plan = False
+    progress = False
+    changes = False
+    depth = None
+    minsize = 0
+    sort = 'name'
+    top = 0
+    nosymlinks = False
+    checksum = False
+    verify = False
+    sample = 100
+    window = 0
+    adaptive = False
+    linkfarm = False
+    catalog = None
+    history = None
+    since = None
+    until = None
+    every = 1
+    thin = []
+    space = False
     for opt, val in opts:
         if opt in ("-v", "--verbose"):
             verbose = True
+        elif opt == '--adaptive':
+            adaptive = True
+        elif opt == '--bwlimit':
+            rate = parsesize(val)
+            if not rate:
+                print "Invalid rate: %s" % val
+                sys.exit(2)
+            bytethrottle.setrate(rate)
+        elif opt == '--catalog':
+            catalog = val
+        elif opt == '--changes':
+            changes = True
+        elif opt in ("-d", "--depth"):
+            try:
+                depth = int(val)
+            except ValueError:
+                depth = -1
+            if depth < 0:
+                print "Invalid depth: %s" % val
+                sys.exit(2)
+        elif opt == '--every':
+            try:
+                every = int(val)
+            except ValueError:
+                every = 0
+            if every < 1:
+                print "Invalid number of snapshots: %s" % val
+                sys.exit(2)
+        elif opt == '--exclude':
+            pathrules.exclude(val)
+        elif opt == '--exclude-from':
+            try:
+                invalid = pathrules.read(val)
+            except IOError, e:
+                print "Cannot read %s: %s" % (val, e.strerror)
+                sys.exit(2)
+            if invalid is not None:
+                print "Invalid rule in %s: %s" % (val, invalid)
+                sys.exit(2)
+        elif opt == '--include':
+            if not pathrules.include(val):
+                print "Invalid path: %s" % val
+                sys.exit(2)
+        elif opt == '--history':
+            history = val
+        elif opt == '--linkfarm':
+            linkfarm = True
+        elif opt in ("-m", "--minsize"):
+            minsize = parsesize(val)
+            if minsize is None:
+                print "Invalid size: %s" % val
+                sys.exit(2)
+        elif opt == '--nosymlinks':
+            nosymlinks = True
+        elif opt == '--sample':
+            try:
+                sample = float(val)
+            except ValueError:
+                sample = 0
+            if not 0 < sample <= 100:
+                print "Invalid percentage: %s" % val
+                sys.exit(2)
+        elif opt in ('--since', '--until'):
+            if not re.match(r'^\d{4}-\d{2}-\d{2}(-\d{6})?$', val):
+                print "Invalid date: %s" % val
+                sys.exit(2)
+            if opt == '--since':
+                since = val
+            else:
+                until = val
+        elif opt == '--sort':
+            if val not in ('old', 'new', 'name'):
+                print "Invalid sort key: %s" % val
+                sys.exit(2)
+            sort = val
+        elif opt == '--thin':
+            thin = parsethin(val)
+            if thin is None:
+                print "Invalid thinning: %s" % val
+                sys.exit(2)
+        elif opt == '--top':
+            try:
+                top = int(val)
+            except ValueError:
+                top = 0
+            if top < 1:
+                print "Invalid number of lines: %s" % val
+                sys.exit(2)
+        elif opt == '--checksum':
+            checksum = True
+        elif opt == '--dedup':
+            dedup = True
         elif opt in ("-h", "--help"):
             usage()
             sys.exit()
+        elif opt in ("-j", "--jobs"):
+            try:
+                jobs = int(val)
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                print "Invalid number of jobs: %s" % val
+                sys.exit(2)
+        elif opt == '--opslimit':
+            try:
+                rate = float(val)
+            except ValueError:
+                rate = 0
+            if rate <= 0:
+                print "Invalid rate: %s" % val
+                sys.exit(2)
+            opthrottle.setrate(rate)
+        elif opt == '--ordered':
+            try:
+                window = int(val)
+            except ValueError:
+                window = 0
+            if window < 1:
+                print "Invalid number of files: %s" % val
+                sys.exit(2)
+        elif opt in ("-p", "--pipeline"):
+            try:
+                pipeline = int(val)
+            except ValueError:
+                pipeline = 0
+            if pipeline < 1:
+                print "Invalid number of processes: %s" % val
+                sys.exit(2)
         elif opt in ("-n", "--dry-run"):
             dryrun = True
+        elif opt == '--plan':
+            plan = True
+        elif opt == '--progress':
+            progress = True
+        elif opt == '--space':
+            space = True
+        elif opt == '--stats':
+            statsfile = val
         elif opt == '--nochown':
-            # Nullify the chown function defined above.
-            global chown
+            # Nullify the chown functions defined above.
+            global chown, fchown
             chown = lambda path, uid, gid: ""
+            fchown = lambda fd, path, uid, gid: ""
+        elif opt == '--verify':
+            verify = True
         elif opt in ("-x", "--xattr"):
             extattr = True
             # Copying only the extended attributes means that no other
@@ -529,6 +4157,28 @@ def main():
             dryrun = True
         else:
             assert False, "unhandled option: %s" % opt
+    snapfilter = None
+    if since or until or every > 1 or thin:
+        snapfilter = SnapshotFilter(since, until, every, thin)
+    if len(args) == 1 and (changes or history or catalog or space):
+        try:
+            if space:
+                spacebackupdb(args[0], depth, top or 10, snapfilter)
+            elif changes:
+                report = Catalog(args[0])
+                reportchanges(report.prev or '-', report.name, depth,
+                              minsize, sort, top, nosymlinks,
+                              report.changes())
+            elif history:
+                reporthistory(args[0], history)
+            else:
+                indexbackupdb(args[0], catalog)
+        except (IOError, OSError), e:
+            print "ERROR: %s" % e
+            sys.exit(1)
+        except KeyboardInterrupt:
+            sys.exit(1)
+        return
     if len(args) != 2:
         print "Missing required arguments. Invoke with -h for help."
         sys.exit(2)
@@ -547,8 +4197,23 @@ def main():
     if not os.path.isdir(dst):
         print "%s is not a directory!" % dst
         sys.exit(1)
+    if changes:
+        try:
+            reportchanges(src, dst, depth, minsize, sort, top, nosymlinks)
+        except KeyboardInterrupt:
+            sys.exit(1)
+        return
+    if verify:
+        try:
+            if not verifybackupdb(src, dst, jobs, sample, snapfilter):
+                sys.exit(1)
+        except KeyboardInterrupt:
+            sys.exit(1)
+        return
     try:
-        copybackupdb(src, dst, verbose, dryrun, extattr)
+        copybackupdb(src, dst, verbose, dryrun, extattr, jobs, dedup,
+                     pipeline, statsfile, plan, progress, checksum, window,
+                     adaptive, linkfarm, catalog, snapfilter)
     except KeyboardInterrupt:
         print "Exiting..."
         sys.exit(1)